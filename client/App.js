@@ -5,6 +5,8 @@ import { vs2015 } from 'react-syntax-highlighter/dist/cjs/styles/hljs';
 import { CopyToClipboard } from 'react-copy-to-clipboard';
 
 let recognition;
+// The server keeps a separate chat history for each session
+const sessionId = window.crypto.randomUUID();
 
 const ChatbotMessage = ({ message }) => {
   let returnval = ''
@@ -36,6 +38,13 @@ const ChatbotMessage = ({ message }) => {
                   </div>
                 </div>
   }
+  else if (message.type === 'Mixed') {
+     // prose and highlighted code blocks, formatted and escaped by the server
+     returnval = <div className="chatbot-message">
+                  <div className="chatbot-message-bubble"
+                       dangerouslySetInnerHTML={{ __html: message.text }} />
+                </div>
+  }
   else { // assume text
      returnval = <div className="chatbot-message">
                   <div className="chatbot-message-bubble">
@@ -141,7 +150,7 @@ const ChatbotRequestReplyInterface = () => {
 
   const call_server = (input, command) => {
     console.log('input= %s, command=%s', input, command)
-    const data = {text: input, command: command};
+    const data = {text: input, command: command, session_id: sessionId};
 
     fetch('http://localhost:5000', {
       method: 'POST',
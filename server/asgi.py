@@ -0,0 +1,238 @@
+""" This is the asyncio (ASGI) serving path of the chat server.
+It accepts the same JSON commands as the Flask server in server.py, but every request is a
+coroutine: while a conversation waits on OpenAI, Pinecone or SerpAPI the event loop serves
+other requests, so a single process can hold hundreds of in-flight conversations.
+
+Run it with any ASGI server, e.g.
+    uvicorn server.asgi:app --port 5000
+or
+    python -m server.asgi
+"""
+import time
+import json
+import asyncio
+import argparse
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+from . import server as wsgi
+from .conversation import Conversation
+from .postprocess import postprocess
+from . import metrics
+
+app = cors(Quart(__name__))
+
+app.config['JSON_AS_ASCII'] = False
+app.config['JSON_SORT_KEYS'] = False
+
+
+async def get_response(text, session_id=None):
+    """
+    Get a response from the Open AI API, returns the ResponseType and the text
+    """
+    conversation = wsgi.sessions.get(session_id)
+    response = (await conversation.aget_response(text, wsgi.VERBOSE)).strip()
+
+    return postprocess(response)
+
+
+async def stream_response(text, session_id=None):
+    """
+    Stream a response from the Open AI API as server-sent events
+    """
+    start = time.perf_counter()
+    status = "error"
+    try:
+        conversation = wsgi.sessions.get(session_id)
+        async for event, data in conversation.aget_response_stream(text, wsgi.VERBOSE):
+            if event == "done":
+                rtype, response = postprocess(data.strip())
+                yield wsgi.format_event(event, {'type': rtype.name, 'text': response})
+            else:
+                yield wsgi.format_event(event, {'text': data})
+        status = "ok"
+    except (GeneratorExit, asyncio.CancelledError):
+        # the client disconnected before the answer was complete
+        status = "disconnected"
+        raise
+    finally:
+        metrics.record_request("stream-response", time.perf_counter() - start, status)
+
+
+async def write_facts(facts):
+    """
+    Write a batch of facts to the Azure blob storage concurrently
+    Returns the status of every fact, in input order
+    """
+    semaphore = asyncio.Semaphore(wsgi.FACT_WRITE_THREADS)
+
+    async def write(index, jsonfact, blob_name):
+        async with semaphore:
+            try:
+                await wsgi.azc.astore_json_in_blob(jsonfact, blob_name)
+                return {'index': index, 'status': 'ok', 'blob': blob_name}
+            except Exception as err: # pylint: disable=broad-except
+                return {'index': index, 'status': 'error', 'error': str(err)}
+
+    # the names are allocated in input order so the blobs sort like the batch
+    return await asyncio.gather(*[write(index, jsonfact, wsgi.default_blob_name())
+                                  for index, jsonfact in enumerate(facts)])
+
+
+@app.route('/', methods=['POST'])
+async def handle_data():
+    """
+    Handle the data from the client
+    """
+    data = await request.get_json()
+
+    text = data['text']
+    command = data['command']
+    # each client keeps its own conversation history
+    session_id = data.get('session_id')
+    error = wsgi.sessions.get_id_error(session_id) or wsgi.get_text_error(command, text)
+    if error is not None:
+        return jsonify({'type': 'Text', 'text': error}), 400
+
+    if command == "stream-response":
+        # Send the tokens to the client as they arrive, the request is timed by the stream
+        return Response(stream_response(text, session_id),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    start = time.perf_counter()
+    status = "error"
+    try:
+        output = await handle_command(text, command, session_id)
+        status = "ok"
+    finally:
+        metrics.record_request(command, time.perf_counter() - start, status)
+
+    # Return the output as a JSON response
+    return jsonify(output)
+
+
+async def handle_command(text, command, session_id):
+    """
+    Run a command that is answered with a single JSON object
+    """
+    output = {}
+    if command == "get-response":
+        rtype, response = await get_response(text, session_id)
+        output = {'type': rtype.name, 'text': response}
+    elif command == "clear-history":
+        # clear the conversation history of this session only
+        wsgi.sessions.reset(session_id)
+        output = {'type': 'Text', 'text': "History cleared."}
+    elif command == "create-training-file":
+        # text is the --newer-than date, the export blocks on its download threads so it
+        # runs in the default executor and the event loop keeps serving other requests
+        loop = asyncio.get_running_loop()
+        filename, count = await loop.run_in_executor(None, wsgi.create_training_file, text)
+        output = {'type': 'Text', 'text': f"Wrote {count} facts to {filename}."}
+    elif command == "write-fact":
+        # write the fact to the fact file
+        await wsgi.azc.astore_json_in_blob(text, wsgi.default_blob_name())
+    elif command == "write-facts":
+        # text is a list of facts
+        output = wsgi.write_facts_output(await write_facts(text))
+    elif command == "kill-all-facts":
+        print("Functionality is disabled to prevent accidental deletion of all facts.")
+    else:
+        print("Unknown command:" + command)
+
+    return output
+
+
+async def read_lines(body):
+    """
+    Split a streamed request body into lines, the line endings are kept
+    """
+    pending = b""
+    async for chunk in body:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if pending:
+        yield pending
+
+
+@app.route('/facts', methods=['POST'])
+async def handle_facts():
+    """
+    Write the facts of a JSONL (one fact per line) request body
+    The body is read as a stream and written in batches, so it can be arbitrarily large.
+    A malformed line gets an error status and the following lines are still written
+    """
+    start = time.perf_counter()
+    status = "error"
+    try:
+        batch_size = 4 * wsgi.FACT_WRITE_THREADS
+        results = []
+        batch = []
+        # position in the body of each fact of the batch
+        positions = []
+
+        async def flush():
+            for fact_position, result in zip(positions, await write_facts(batch)):
+                result['index'] = fact_position
+                results.append(result)
+            batch.clear()
+            positions.clear()
+
+        position = 0
+        async for line in read_lines(request.body):
+            if not line.strip():
+                continue
+            try:
+                batch.append(json.loads(line))
+                positions.append(position)
+            except ValueError as err:
+                # JSONDecodeError and UnicodeDecodeError, only this fact fails
+                results.append({'index': position, 'status': 'error', 'error': str(err)})
+            position += 1
+            if len(batch) >= batch_size:
+                await flush()
+        await flush()
+
+        results.sort(key=lambda result: result['index'])
+        status = "ok"
+    finally:
+        metrics.record_request("write-facts", time.perf_counter() - start, status)
+
+    return jsonify(wsgi.write_facts_output(results))
+
+
+@app.route('/metrics', methods=['GET'])
+async def handle_metrics():
+    """
+    Expose the latency and token metrics in the Prometheus text format
+    """
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+@app.after_serving
+async def close_clients():
+    """
+    Close the HTTP sessions held by the asyncio clients
+    """
+    await Conversation.tls.aclose()
+    await wsgi.azc.aclose()
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Verbose logging')
+    parser.add_argument('-p', '--port', type=int, default=5000,
+                        help='Port to listen on')
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        wsgi.VERBOSE = True
+        print("Verbose logging enabled.")
+
+    uvicorn.run(app, port=args.port)
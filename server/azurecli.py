@@ -4,8 +4,15 @@ Azure Storage and store and retrieve JSON objects
 """
 import os
 import json
+import asyncio
+import threading
+import requests
 import azure.storage.blob
+import azure.storage.blob.aio
+import azure.identity.aio
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import ClientSecretCredential
+from . import metrics
 
 
 class AzureCli:
@@ -19,58 +26,163 @@ class AzureCli:
     client_id = os.environ.get("AZURE_CLIENT_ID")
     client_secret = os.environ.get("AZURE_CLIENT_SECRET")
     tenant_id = os.environ.get("AZURE_TENANT_ID")
+    # Size of the HTTP connection pool shared by all blob operations
+    pool_size = int(os.environ.get("AZURE_POOL_SIZE", "32"))
+
+    # The credential caches its token and the clients are thread safe, so they are
+    # created once and shared by every AzureCli instance and thread
+    _lock = threading.Lock()
+    _container_client = None
 
     def __init__(self):
-        return
+        # the asyncio clients are bound to the event loop they were created on
+        self._aio_lock = None
+        self._aio_credential = None
+        self._aio_container_client = None
 
     def connect_to_storage_account(self):
         """
         Connect to the Azure Storage account
+        The container client is created on first use and then reused
         """
-        credential = ClientSecretCredential(
-            client_id=self.client_id, client_secret=self.client_secret, tenant_id=self.tenant_id)
-        blob_service = azure.storage.blob.BlobServiceClient(
-            account_url=self.account_url, account_name=self.account_name, credential=credential)
-        container_client = blob_service.get_container_client(
-            self.container_name)
-        return container_client
+        container_client = AzureCli._container_client
+        if container_client is not None:
+            return container_client
+
+        with AzureCli._lock:
+            if AzureCli._container_client is None:
+                credential = ClientSecretCredential(
+                    client_id=self.client_id, client_secret=self.client_secret,
+                    tenant_id=self.tenant_id)
+
+                # pool the HTTP connections so requests reuse their TLS sessions
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+
+                blob_service = azure.storage.blob.BlobServiceClient(
+                    account_url=self.account_url, account_name=self.account_name,
+                    credential=credential,
+                    transport=RequestsTransport(session=session, session_owner=False))
+                AzureCli._container_client = blob_service.get_container_client(
+                    self.container_name)
+
+            return AzureCli._container_client
+
+    async def aconnect_to_storage_account(self):
+        """
+        Connect to the Azure Storage account with the asyncio client
+        The container client is created on first use and then reused
+        """
+        if self._aio_container_client is not None:
+            return self._aio_container_client
+
+        if self._aio_lock is None:
+            self._aio_lock = asyncio.Lock()
+
+        async with self._aio_lock:
+            if self._aio_container_client is None:
+                self._aio_credential = azure.identity.aio.ClientSecretCredential(
+                    client_id=self.client_id, client_secret=self.client_secret,
+                    tenant_id=self.tenant_id)
+                blob_service = azure.storage.blob.aio.BlobServiceClient(
+                    account_url=self.account_url, credential=self._aio_credential)
+                self._aio_container_client = blob_service.get_container_client(
+                    self.container_name)
+
+        return self._aio_container_client
+
+    async def aclose(self):
+        """
+        Close the asyncio clients
+        """
+        if self._aio_container_client is not None:
+            await self._aio_container_client.close()
+            await self._aio_credential.close()
+            self._aio_container_client = None
+            self._aio_credential = None
 
     def store_json_in_blob(self, json_object, blob_name):
         """
         Store a JSON object in a blob
         """
-        # Convert the JSON object to a string
-        blob_text = json.dumps(json_object)
+        with metrics.timed("blob_upload", "azure"):
+            # Convert the JSON object to a string
+            blob_text = json.dumps(json_object)
 
-        container_client = self.connect_to_storage_account()
-        blob_client = container_client.get_blob_client(blob_name)
-        blob_client.upload_blob(blob_text, overwrite=True)
+            container_client = self.connect_to_storage_account()
+            blob_client = container_client.get_blob_client(blob_name)
+            blob_client.upload_blob(blob_text, overwrite=True)
 
     def get_json_from_blob(self, blob_name):
         """
         Get a JSON object from a blob
         """
-        container_client = self.connect_to_storage_account()
-        blob_client = container_client.get_blob_client(blob_name)
-        blob_text = blob_client.download_blob().readall()
-        json_object = json.loads(blob_text)
-        return json_object
+        with metrics.timed("blob_download", "azure"):
+            container_client = self.connect_to_storage_account()
+            blob_client = container_client.get_blob_client(blob_name)
+            blob_text = blob_client.download_blob().readall()
+            json_object = json.loads(blob_text)
+            return json_object
+
+    async def astore_json_in_blob(self, json_object, blob_name):
+        """
+        This is the asyncio version of store_json_in_blob
+        """
+        with metrics.timed("blob_upload", "azure"):
+            blob_text = json.dumps(json_object)
+
+            container_client = await self.aconnect_to_storage_account()
+            blob_client = container_client.get_blob_client(blob_name)
+            await blob_client.upload_blob(blob_text, overwrite=True)
+
+    async def aget_json_from_blob(self, blob_name):
+        """
+        This is the asyncio version of get_json_from_blob
+        """
+        with metrics.timed("blob_download", "azure"):
+            container_client = await self.aconnect_to_storage_account()
+            blob_client = container_client.get_blob_client(blob_name)
+            downloader = await blob_client.download_blob()
+            blob_text = await downloader.readall()
+            json_object = json.loads(blob_text)
+            return json_object
 
     def get_blob_list(self):
         """
         Get a list of blobs in the container
         """
-        container_client = self.connect_to_storage_account()
-        blob_list = container_client.list_blobs()
-        return blob_list
+        with metrics.timed("blob_list", "azure"):
+            container_client = self.connect_to_storage_account()
+            blob_list = container_client.list_blobs()
+            return blob_list
+
+    async def aget_blob_list(self):
+        """
+        This is the asyncio version of get_blob_list, it returns an async iterator
+        """
+        container_client = await self.aconnect_to_storage_account()
+        return container_client.list_blobs()
 
     def delete_blob(self, blob_name):
         """
         Delete a blob
         """
-        container_client = self.connect_to_storage_account()
-        blob_client = container_client.get_blob_client(blob_name)
-        blob_client.delete_blob()
+        with metrics.timed("blob_delete", "azure"):
+            container_client = self.connect_to_storage_account()
+            blob_client = container_client.get_blob_client(blob_name)
+            blob_client.delete_blob()
+
+    async def adelete_blob(self, blob_name):
+        """
+        This is the asyncio version of delete_blob
+        """
+        with metrics.timed("blob_delete", "azure"):
+            container_client = await self.aconnect_to_storage_account()
+            blob_client = container_client.get_blob_client(blob_name)
+            await blob_client.delete_blob()
 
     def get_blob_url(self, blob_name):
         """
@@ -0,0 +1,191 @@
+"""
+This module counts prompt tokens and assembles prompts that fit in a token budget
+"""
+import os
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - falls back to an estimate
+    tiktoken = None
+
+# Every chat message costs a few tokens on top of its content, and the reply is primed
+# with a few more (see the OpenAI cookbook on counting chat tokens)
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model):
+    """
+    Get the tokenizer for the model, None when tiktoken is not available
+    """
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as err: # pylint: disable=broad-except
+        # tiktoken downloads its encodings on first use, fall back when that fails
+        print("Could not load the tokenizer, estimating token counts:", err)
+        return None
+
+
+@lru_cache(maxsize=65536)
+def count_tokens(text, model="gpt-3.5-turbo"):
+    """
+    Count the tokens in a piece of text. Results are memoized, so the messages that are
+    repeated on every turn (instructions, history, summary) are only tokenized once
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        # roughly 4 characters per token for English text
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text, max_tokens, model="gpt-3.5-turbo"):
+    """
+    Truncate a piece of text to at most max_tokens tokens
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def split_exchanges(history):
+    """
+    Split the history into exchanges, each starts with a user message and holds the answer
+    and the function calls and tool outputs of that turn, so they are kept or dropped together
+    """
+    exchanges = []
+    for message in history:
+        if message["role"] == "user" or not exchanges:
+            exchanges.append([])
+        exchanges[-1].append(message)
+    return exchanges
+
+
+class TokenBudget:
+    """
+    This class assembles the chat prompt so that it fits in a token budget
+    The parts of the prompt are added in priority order:
+    1. the instructions and the question (always included)
+    2. the conversation summary
+    3. the most recent question/answer pairs
+    4. the retrieved context facts, best match first (the last one may be truncated)
+    5. older question/answer pairs, newest first
+    Whatever does not fit is dropped, so the least relevant facts and the oldest
+    history go first. The selected parts are emitted in the usual prompt order
+    """
+    max_prompt_tokens = int(os.environ.get("PROMPT_TOKEN_BUDGET", "3000"))
+    recent_history_pairs = 2
+    # a truncated fact shorter than this is not worth including
+    min_fact_tokens = 32
+
+    def __init__(self, max_prompt_tokens=None, model="gpt-3.5-turbo"):
+        if max_prompt_tokens is not None:
+            self.max_prompt_tokens = max_prompt_tokens
+        self.model = model
+
+    def count_message(self, message):
+        """
+        Count the tokens used by one chat message, including its function calls
+        """
+        tokens = TOKENS_PER_MESSAGE + count_tokens(message["role"], self.model) + \
+            count_tokens(message["content"] or "", self.model)
+        for call in message.get("tool_calls") or []:
+            tokens += count_tokens(call["function"]["name"], self.model) + \
+                count_tokens(call["function"]["arguments"], self.model)
+        return tokens
+
+    def count_messages(self, messages):
+        """
+        Count the tokens used by a list of chat messages, including the reply priming
+        """
+        return sum(self.count_message(message) for message in messages) + TOKENS_PER_REPLY
+
+    def _select_facts(self, facts, format_context, remaining):
+        """
+        Select the facts, best first, that fit in the remaining budget
+        Returns the context messages and the number of tokens they use
+        """
+        if not facts:
+            return [], 0
+
+        overhead = self.count_messages(format_context("")) - TOKENS_PER_REPLY
+        if overhead >= remaining:
+            return [], 0
+
+        selected = []
+        used = overhead
+        for fact in facts:
+            # facts are joined by newlines, count one token for the separator
+            fact_tokens = count_tokens(fact, self.model) + 1
+            if used + fact_tokens <= remaining:
+                selected.append(fact)
+                used += fact_tokens
+                continue
+
+            available = remaining - used - 1
+            if available >= self.min_fact_tokens:
+                selected.append(truncate_tokens(fact, available, self.model))
+                used = remaining
+            break
+
+        if not selected:
+            return [], 0
+
+        return format_context("\n".join(selected)), used
+
+    def assemble(self, intro, facts, format_context, summary, history, question):
+        """
+        Assemble the prompt:
+        intro -- the instruction messages
+        facts -- the list of retrieved facts, best match first, a fact may span lines
+        format_context -- a function that wraps the joined facts in the context messages
+        summary -- the summary messages of older conversations
+        history -- the question/answer messages and tool transcripts, oldest first
+        question -- the question messages
+        """
+        remaining = self.max_prompt_tokens - self.count_messages(intro + question)
+
+        summary_tokens = self.count_messages(summary) - TOKENS_PER_REPLY
+        if summary_tokens <= remaining:
+            remaining -= summary_tokens
+        else:
+            summary = []
+
+        # history is kept in whole exchanges, newest first
+        pairs = split_exchanges(history)[::-1]
+        pair_tokens = [self.count_messages(pair) - TOKENS_PER_REPLY for pair in pairs]
+
+        kept_pairs = 0
+        for tokens in pair_tokens[:self.recent_history_pairs]:
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            kept_pairs += 1
+
+        facts = [fact for fact in facts or [] if fact.strip()]
+        context_messages, context_tokens = self._select_facts(facts, format_context, remaining)
+        remaining -= context_tokens
+
+        if kept_pairs == min(len(pairs), self.recent_history_pairs):
+            for tokens in pair_tokens[kept_pairs:]:
+                if tokens > remaining:
+                    break
+                remaining -= tokens
+                kept_pairs += 1
+
+        kept_history = [message for pair in reversed(pairs[:kept_pairs]) for message in pair]
+
+        return intro + context_messages + summary + kept_history + question
@@ -1,112 +1,309 @@
 """
 This module contains the class that encapsulates the conversation history and context
 """
+import os
+import threading
 import traceback
 import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from .openaicli import OpenAICli
 from .prompt import Prompt
-from .pineconecli import PineconeCli
+from .indexcli import get_index_cli
 from .tools import Tools
+from .budget import TokenBudget, split_exchanges
+from .responsecache import ResponseCache
+from .scheduler import estimate_tokens
+from . import metrics
+
+# A tool invocation in the text of a response, $tool(parameter), a quoted parameter may
+# contain parentheses
+TOOL_INVOCATION = re.compile(r"\$(\w+)\(\s*(?:(['\"])(.*?)\2|([^)]*))\s*\)")
 
 
 class Conversation:
     """
     This class is used to encapsulate the conversation history and context
+    The history is per instance (one instance per session), the API clients are shared
     """
-    conversation_summary = []
-    unsummarized_conversations = 0
-    # Initialize conversation history with an empty list
-    conversation_history = []
+    # Per session memory caps, the oldest question/answer pairs are dropped first
+    max_history_messages = int(os.environ.get("CHAT_MAX_HISTORY_MESSAGES", "40"))
+    max_history_chars = int(os.environ.get("CHAT_MAX_HISTORY_CHARS", "16000"))
+    # Summaries are generated off the request path on these threads
+    summarize_executor = ThreadPoolExecutor(
+        max_workers=int(os.environ.get("CHAT_SUMMARIZE_THREADS", "4")),
+        thread_name_prefix="summarize")
     oai = OpenAICli()
-    pc = PineconeCli()
+    pc = get_index_cli()
     tls = Tools()
     default_context = tls.get_default_context()
     prompt = Prompt()
     intro_prompt = prompt.get_intro_prompt()
+    budget = TokenBudget(model=oai.model)
+    # shared by all sessions, disabled unless RESPONSE_CACHE_ENABLED=1
+    response_cache = ResponseCache()
 
     def __init__(self):
-        return
+        self.conversation_summary = []
+        self.unsummarized_conversations = 0
+        # Initialize conversation history with an empty list
+        self.conversation_history = []
+        # Number of messages ever added, used to find the messages added during a summary
+        self.messages_added = 0
+        # Bumped by reset so that a summary of the old history is discarded
+        self.generation = 0
+        self.summary_in_progress = False
+        # scopes the cached answers that were built on the history of this conversation
+        self.cache_scope = uuid.uuid4().hex
+        self.lock = threading.RLock()
 
     def reset(self):
         """
         This function resets the conversation history
         """
-        self.conversation_summary = []
-        self.unsummarized_conversations = 0
-        self.conversation_history = []
+        with self.lock:
+            self.conversation_summary = []
+            self.unsummarized_conversations = 0
+            self.conversation_history = []
+            self.generation += 1
+            self.cache_scope = uuid.uuid4().hex
 
     # Define function to summarize conversation history using GPT model
-    def summarize_conversations(self):
+    def summarize_conversations(self, conversation_history=None):
         """
         This function summarizes the conversation history using GPT model
         """
+        if conversation_history is None:
+            conversation_history = self.conversation_history
+        # the answers already carry what the tools returned, the transcripts are left out
+        conversation_history = [message for message in conversation_history
+                                if message["role"] != "tool" and not message.get("tool_calls")]
         summarizeprompt = self.prompt.get_summarize_conversation_prompt() + \
-            self.conversation_history
-        new_summarized_conversation = self.oai.get_response(summarizeprompt)
+            conversation_history
+        new_summarized_conversation = self.oai.get_response(
+            summarizeprompt, call_type="summarize")
 
         formatted_chat_summary = self.prompt.get_summary_prompt(
             new_summarized_conversation)
 
         return formatted_chat_summary
 
+    def _summarize_in_background(self, conversation_history, messages_added, generation):
+        """
+        This function runs on a summarize thread. When the summary is ready it is swapped
+        in atomically together with the shortened history
+        """
+        try:
+            with metrics.timed("summarize", self.oai.model):
+                summary = self.summarize_conversations(conversation_history)
+        except Exception as err: # pylint: disable=broad-except
+            # Keep using the previous summary, the next summary will cover these turns
+            print("Error summarizing conversation:", err)
+            traceback.print_exc()
+            with self.lock:
+                self.summary_in_progress = False
+            return
+
+        with self.lock:
+            self.summary_in_progress = False
+            if generation != self.generation:
+                # The history was reset while the summary was generated
+                return
+
+            # Keep the last 5 (*2) summarized conversations and everything added since,
+            # without starting in the middle of an exchange
+            new_messages = self.messages_added - messages_added
+            history = self.conversation_history[-(10 + new_messages):]
+            while history and history[0]["role"] != "user":
+                history = history[1:]
+            self.conversation_summary = summary
+            self.conversation_history = history
+
     def get_conversation_history(self):
         """
         This function returns the conversation history
         """
-        return self.conversation_summary+self.conversation_history
+        with self.lock:
+            return self.conversation_summary+self.conversation_history
+
+    def _trim_history(self):
+        """
+        This function enforces the memory caps by dropping the oldest exchanges, an exchange
+        is a question/answer pair with the tool transcript of its turn
+        """
+        exchanges = split_exchanges(self.conversation_history)
+        history_messages = len(self.conversation_history)
+        history_chars = sum(len(message["content"] or "")
+                            for message in self.conversation_history)
+
+        while len(exchanges) > 1 and \
+                (history_messages > self.max_history_messages or
+                 history_chars > self.max_history_chars):
+            dropped = exchanges.pop(0)
+            history_messages -= len(dropped)
+            history_chars -= sum(len(message["content"] or "") for message in dropped)
+
+        self.conversation_history = [message for exchange in exchanges for message in exchange]
 
-    def _add_conversation(self, question, answer):
+    def get_memory_size(self):
+        """
+        This function returns the number of characters held by this conversation
+        """
+        return sum(len(message["content"] or "") for message in self.get_conversation_history())
+
+    def _add_conversation(self, question, answer, transcript=None):
         """
         This function adds the question and answer to the conversation history
+        The function calls and tool outputs of the turn go between the question and the answer
         """
-        if answer is not None and answer != "":
+        if answer is None or answer == "":
+            return
+
+        qa_history = self.prompt.get_qa_history_prompt(question=question, answer=answer)
+        if transcript:
+            qa_history = qa_history[:1] + transcript + qa_history[1:]
+
+        with self.lock:
             # conversation contains the question and answer
-            self.conversation_history += self.prompt.get_qa_history_prompt(
-                question=question, answer=answer)
+            self.conversation_history = self.conversation_history + qa_history
+            self.messages_added += len(qa_history)
             self.unsummarized_conversations += 1
+            self._trim_history()
 
-            if self.unsummarized_conversations > 10:
-                # Summarize older conversations using GPT model
-                self.conversation_summary = self.summarize_conversations()
+            if self.unsummarized_conversations > 10 and not self.summary_in_progress:
+                # Summarize older conversations using GPT model in the background,
+                # until it finishes the prompts use the previous summary and the raw history
+                self.summary_in_progress = True
+                self.unsummarized_conversations = 0
+                self.summarize_executor.submit(
+                    self._summarize_in_background, list(self.conversation_history),
+                    self.messages_added, self.generation)
 
-                # Keep only the last 5 (*2) conversations in the history
-                self.conversation_history = self.conversation_history[-10:]
+    def parse_tools(self, text):
+        """
+        This function parses the text to find the tool invocations, $tool(parameter)
+        It is used when the model does not call the tools through the function calling API,
+        returns the list of (tool, parameter) calls in the order they appear
+        """
+        calls = []
+        tools = self.tls.get_tools()
+        for match in TOOL_INVOCATION.finditer(text):
+            tool_name = match.group(1)
+            tool_param = (match.group(3) if match.group(2) else match.group(4)).strip()
+            if tool_name not in tools:
+                continue
+            if tools[tool_name]["parameter"] is None:
+                calls.append((tool_name, None))
+            elif tool_param:
+                calls.append((tool_name, tool_param))
 
-                self.unsummarized_conversations = 0
+        # the same call is only run once
+        return list(dict.fromkeys(calls))
 
     def parse_tool(self, text):
         """
         This function parses the text to see if it contains a tool invocation
         """
-        match = re.search(r"\$search\(\s*(['\"])?([^'\"]+)\1?\s*\)", text)
-        if match is not None:
-            tool_name = "search"
-            tool_param = match.group(2)
-
-            if tool_name is not None and tool_param is not None:
-                return True, tool_name, tool_param
+        calls = self.parse_tools(text)
+        if calls:
+            tool_name, tool_param = calls[0]
+            return True, tool_name, tool_param
 
         return False, None, None
 
-    def _process_response(self, response):
+    def _get_functions(self, attempt):
+        """
+        The tools offered through the function calling API, the last attempt gets none
+        so that the model has to answer
+        """
+        if self.oai.function_calling and attempt == 0:
+            return self.tls.get_functions()
+        return None
+
+    @staticmethod
+    def _get_call_type(attempt):
+        """
+        The call type used to route a completion, the attempts after the first one
+        answer with the tool outputs in the history
+        """
+        return "answer" if attempt == 0 else "tool"
+
+    def _parse_function_calls(self, function_calls):
         """
-        This function processes the response to see if it contains a tool invocation
+        Get the (tool, parameter) call of each (id, name, arguments) function call, None
+        when it is invalid, and the distinct valid calls to run
         """
-        is_tool, tool_name, tool_param = self.parse_tool(response)
+        parsed = [self.tls.parse_function_call(name, arguments)
+                  for _, name, arguments in function_calls]
+        return parsed, list(dict.fromkeys(call for call in parsed if call is not None))
 
-        if is_tool:
-            # Call the tool with the given parameter
-            tool_output, source = self.tls.call_tool(tool_name, tool_param)
+    def _add_function_outputs(self, response, function_calls, parsed, outputs, transcript):
+        """
+        Add the function calls to the transcript of the turn, as the assistant message that
+        requested them followed by one tool message per call, linked by the call id.
+        outputs maps each (tool, parameter) call to its (output, source)
+        """
+        transcript += self.prompt.get_tool_calls_prompt(response, function_calls)
+        for (call_id, name, _), call in zip(function_calls, parsed):
+            tool_output, source = outputs.get(call, (None, None))
+            if tool_output is None:
+                tool_output = f"The {name} call failed, answer without it."
+            else:
+                print("Source:", source)
+            transcript += self.prompt.get_tool_output_prompt(call_id, str(tool_output))
 
+    def _add_tool_outputs(self, calls, results):
+        """
+        Add the outputs of the $tool() invocations to the conversation history, the models
+        that invoke the tools in the text do not support tool messages
+        Returns True when no tool produced an output
+        """
+        done = True
+        for (tool_name, tool_param), (tool_output, source) in zip(calls, results):
             if tool_output is not None:
                 # Add the question and answer to the conversation history
-                self._add_conversation(tool_param, tool_output)
+                self._add_conversation(tool_param or tool_name, tool_output)
                 print("Source:", source)
-                return False
+                done = False
+
+        return done
+
+    def _process_response(self, response, function_calls=None, transcript=None):
+        """
+        This function processes the response to see if it contains tool invocations
+        All the tools requested in the response run concurrently. The function calls and
+        their outputs are appended to transcript, the model must then answer with them
+        Returns True when the response is the answer
+        """
+        if function_calls:
+            parsed, calls = self._parse_function_calls(function_calls)
+            outputs = dict(zip(calls, self.tls.call_tools(calls)))
+            self._add_function_outputs(response, function_calls, parsed, outputs, transcript)
+            return False
+
+        calls = self.parse_tools(response)
+        if not calls:
+            return True
+
+        return self._add_tool_outputs(calls, self.tls.call_tools(calls))
+
+    async def _aprocess_response(self, response, function_calls=None, transcript=None):
+        """
+        This is the asyncio version of _process_response
+        """
+        if function_calls:
+            parsed, calls = self._parse_function_calls(function_calls)
+            outputs = dict(zip(calls, await self.tls.acall_tools(calls)))
+            self._add_function_outputs(response, function_calls, parsed, outputs, transcript)
+            return False
+
+        calls = self.parse_tools(response)
+        if not calls:
+            return True
 
-        return True
+        return self._add_tool_outputs(calls, await self.tls.acall_tools(calls))
 
-    def _get_prompt(self, question, context):
+    def _get_prompt(self, question, facts, transcript=None):
         """
         This used is used to format the prompt based on the provided arguments
         The format of the prompt is as follows:
@@ -120,14 +317,75 @@ class Conversation:
         these are intermingled based on when the tool was needed
         
         Chat Q: in CHAT_Q -- this is the question that the user is asking
+
+        Transcript: the function calls of this turn and their tool outputs, if any
+
+        The context facts and the history are trimmed to fit the token budget
         """
-        self.default_context = self.tls.get_default_context()
-        full_prompt = self.intro_prompt + self.prompt.get_context_prompt(context) +\
-            self.conversation_summary+self.conversation_history +\
-            self.prompt.get_q_prompt(question, self.default_context)
+        with metrics.timed("prompt_assembly"):
+            self.default_context = self.tls.get_default_context()
+            with self.lock:
+                summary = self.conversation_summary
+                history = self.conversation_history
+
+            full_prompt = self.budget.assemble(
+                self.intro_prompt, facts, self.prompt.get_context_prompt, summary, history,
+                self.prompt.get_q_prompt(question, self.default_context,
+                                         self.tls.get_invocations()) + (transcript or []))
 
         return full_prompt
 
+    def _use_response_cache(self, text):
+        """
+        Check if the question may be answered from the response cache
+        """
+        return self.response_cache.enabled and not self.response_cache.depends_on_history(
+            text, len(self.get_conversation_history()) > 0)
+
+    def _cache_parameters(self, model, has_history):
+        """
+        The model parameters that must match for a cached answer to be reused
+        An answer built on the history of this conversation is only reused by it
+        """
+        parameters = (model, self.oai.temperature, self.oai.top_p,
+                      self.oai.frequency_penalty, self.oai.presence_penalty)
+        return parameters + (self.cache_scope,) if has_history else parameters
+
+    def _find_facts(self, text):
+        """
+        Find the facts that match the question, best match first
+        """
+        return [match['fact'] for match in self.pc.find_matches(text)]
+
+    async def _afind_facts(self, text):
+        """
+        This is the asyncio version of _find_facts
+        """
+        return [match['fact'] for match in await self.pc.afind_matches(text)]
+
+    def _get_cached_response(self, text, facts, question_vector, has_history):
+        """
+        Get the cached answer of the question and record it in the history
+        The answer must come from the model the router picks for the question now
+        """
+        prompt_tokens = estimate_tokens(self._get_prompt(text, facts))
+        model = self.oai.router.get_models("answer", prompt_tokens)[0]
+        response = self.response_cache.lookup(
+            question_vector, "\n".join(facts), self._cache_parameters(model, has_history))
+        if response is not None:
+            self._add_conversation(text, response)
+        return response
+
+    def _cache_response(self, facts, question_vector, response, used_tool, models,
+                        has_history):
+        """
+        Cache the answer of the question, keyed on the model that answered it
+        Answers that needed a tool are not cached, they depend on fresh search results
+        """
+        if question_vector is not None and not used_tool and response and models:
+            self.response_cache.store(question_vector, "\n".join(facts),
+                                      self._cache_parameters(models[-1], has_history), response)
+
     def get_response(self, text, verbose=False):
         """
         Get the response from the OpenAI API
@@ -136,23 +394,198 @@ class Conversation:
             response = ""
 
             # Get user input
-            context = self.pc.find_match(text)
+            facts = self._find_facts(text)
+
+            question_vector = None
+            has_history = len(self.get_conversation_history()) > 0
+            if self._use_response_cache(text):
+                # find_matches embedded the question, this comes from the embedding cache
+                question_vector = self.oai.get_embedding(text, self.pc.embedding_model)
+                cached = self._get_cached_response(text, facts, question_vector, has_history)
+                if cached is not None:
+                    return cached
+
+            transcript = []
+            models = []
+            for attempt in range(2):
+                my_prompt = self._get_prompt(text, facts, transcript)
+
+                if verbose:
+                    print("Prompt=", my_prompt)
+                tool_calls = []
+                response = self.oai.get_response(
+                    my_prompt, self._get_functions(attempt), tool_calls,
+                    self._get_call_type(attempt), models)
+                if self._process_response(response, tool_calls, transcript):
+                    break
+
+            if response is not None and response != "":
+                # Add the question and answer to the conversation history
+                self._add_conversation(text, response, transcript)
+                self._cache_response(facts, question_vector, response, attempt > 0, models,
+                                     has_history)
+        except Exception as err: # pylint: disable=broad-except
+            print("Error:", err)
+            traceback.print_exc()
+            response = "Sorry, I hit an internal error. Please try again."
+
+        return response
+
+    def get_response_stream(self, text, verbose=False):
+        """
+        Stream the response from the OpenAI API
+        This is a generator of (event, data) tuples:
+        token -- a piece of the answer as it arrives from the model
+        reset -- the tokens sent so far were a tool invocation and are superseded
+        error -- the request failed, data is the message to show to the user
+        done -- the stream is complete, data is the full response
+        The tool check and the history update run once the model stream finishes
+        """
+        response = ""
+        try:
+            facts = self._find_facts(text)
+
+            question_vector = None
+            has_history = len(self.get_conversation_history()) > 0
+            if self._use_response_cache(text):
+                # find_matches embedded the question, this comes from the embedding cache
+                question_vector = self.oai.get_embedding(text, self.pc.embedding_model)
+                cached = self._get_cached_response(text, facts, question_vector, has_history)
+                if cached is not None:
+                    yield "token", cached
+                    yield "done", cached
+                    return
+
+            transcript = []
+            models = []
+            for attempt in range(2):
+                my_prompt = self._get_prompt(text, facts, transcript)
+
+                if verbose:
+                    print("Prompt=", my_prompt)
+                if attempt > 0:
+                    yield "reset", ""
+
+                response = ""
+                tool_calls = []
+                for token in self.oai.get_response_stream(
+                        my_prompt, self._get_functions(attempt), tool_calls,
+                        self._get_call_type(attempt), models):
+                    response += token
+                    yield "token", token
+                response = response.strip()
+
+                if self._process_response(response, tool_calls, transcript):
+                    break
+
+            if response is not None and response != "":
+                # Add the question and answer to the conversation history
+                self._add_conversation(text, response, transcript)
+                self._cache_response(facts, question_vector, response, attempt > 0, models,
+                                     has_history)
+        except Exception as err: # pylint: disable=broad-except
+            print("Error:", err)
+            traceback.print_exc()
+            response = "Sorry, I hit an internal error. Please try again."
+            yield "error", response
+
+        yield "done", response
+
+    async def aget_response(self, text, verbose=False):
+        """
+        This is the asyncio version of get_response
+        """
+        try:
+            response = ""
+
+            # Get user input
+            facts = await self._afind_facts(text)
 
-            for _ in range(2):
-                my_prompt = self._get_prompt(text, context)
+            question_vector = None
+            has_history = len(self.get_conversation_history()) > 0
+            if self._use_response_cache(text):
+                # afind_matches embedded the question, this comes from the embedding cache
+                question_vector = await self.oai.aget_embedding(text, self.pc.embedding_model)
+                cached = self._get_cached_response(text, facts, question_vector, has_history)
+                if cached is not None:
+                    return cached
+
+            transcript = []
+            models = []
+            for attempt in range(2):
+                my_prompt = self._get_prompt(text, facts, transcript)
 
                 if verbose:
                     print("Prompt=", my_prompt)
-                response = self.oai.get_response(my_prompt)
-                if self._process_response(response):
+                tool_calls = []
+                response = await self.oai.aget_response(
+                    my_prompt, self._get_functions(attempt), tool_calls,
+                    self._get_call_type(attempt), models)
+                if await self._aprocess_response(response, tool_calls, transcript):
                     break
 
             if response is not None and response != "":
                 # Add the question and answer to the conversation history
-                self._add_conversation(text, response)
+                self._add_conversation(text, response, transcript)
+                self._cache_response(facts, question_vector, response, attempt > 0, models,
+                                     has_history)
         except Exception as err: # pylint: disable=broad-except
             print("Error:", err)
             traceback.print_exc()
             response = "Sorry, I hit an internal error. Please try again."
 
         return response
+
+    async def aget_response_stream(self, text, verbose=False):
+        """
+        This is the asyncio version of get_response_stream
+        """
+        response = ""
+        try:
+            facts = await self._afind_facts(text)
+
+            question_vector = None
+            has_history = len(self.get_conversation_history()) > 0
+            if self._use_response_cache(text):
+                # afind_matches embedded the question, this comes from the embedding cache
+                question_vector = await self.oai.aget_embedding(text, self.pc.embedding_model)
+                cached = self._get_cached_response(text, facts, question_vector, has_history)
+                if cached is not None:
+                    yield "token", cached
+                    yield "done", cached
+                    return
+
+            transcript = []
+            models = []
+            for attempt in range(2):
+                my_prompt = self._get_prompt(text, facts, transcript)
+
+                if verbose:
+                    print("Prompt=", my_prompt)
+                if attempt > 0:
+                    yield "reset", ""
+
+                response = ""
+                tool_calls = []
+                async for token in self.oai.aget_response_stream(
+                        my_prompt, self._get_functions(attempt), tool_calls,
+                        self._get_call_type(attempt), models):
+                    response += token
+                    yield "token", token
+                response = response.strip()
+
+                if await self._aprocess_response(response, tool_calls, transcript):
+                    break
+
+            if response is not None and response != "":
+                # Add the question and answer to the conversation history
+                self._add_conversation(text, response, transcript)
+                self._cache_response(facts, question_vector, response, attempt > 0, models,
+                                     has_history)
+        except Exception as err: # pylint: disable=broad-except
+            print("Error:", err)
+            traceback.print_exc()
+            response = "Sorry, I hit an internal error. Please try again."
+            yield "error", response
+
+        yield "done", response
@@ -0,0 +1,175 @@
+"""
+This module contains a content addressed cache for embedding vectors
+Embeddings are keyed by (model, hash of the normalized text). Recently used vectors are
+kept in an in-memory LRU, and every vector is also written to a SQLite file so the cache
+survives restarts
+"""
+import os
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .budget import count_tokens
+
+
+def normalize_text(text):
+    """
+    Normalize the text before it is embedded, so that whitespace variations share a key
+    """
+    return " ".join(text.split())
+
+
+def pack_batches(texts, max_items, max_tokens):
+    """
+    Split the texts into batches of at most max_items texts and about max_tokens tokens
+    A single text larger than max_tokens gets a batch of its own
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class EmbeddingCache:
+    """
+    This class is a two tier (memory and disk) cache of embedding vectors
+    Set EMBEDDING_CACHE_PATH to an empty string to disable the disk tier
+    """
+    path = os.environ.get("EMBEDDING_CACHE_PATH", "embeddings.sqlite")
+    max_memory_items = int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000"))
+
+    def __init__(self, path=None, max_memory_items=None):
+        if path is not None:
+            self.path = path
+        if max_memory_items is not None:
+            self.max_memory_items = max_memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.connection = None
+        if self.path:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, model TEXT, vector BLOB)")
+            self.connection.commit()
+
+    @staticmethod
+    def get_key(model, text):
+        """
+        Get the cache key for a model and a (normalized) text
+        """
+        digest = hashlib.sha256(normalize_text(text).encode("utf8")).hexdigest()
+        return f"{model}:{digest}"
+
+    def _remember(self, key, vector):
+        """
+        Add a vector to the memory tier, must be called with the lock held
+        """
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, model, text):
+        """
+        Get the cached embedding of the text, None when it is not cached
+        """
+        key = self.get_key(model, text)
+        with self.lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+
+            if self.connection is not None:
+                row = self.connection.execute(
+                    "SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    vector = array("f", row[0]).tolist()
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, model, text, vector):
+        """
+        Store the embedding of the text in both tiers
+        """
+        self.put_many(model, [(text, vector)])
+
+    def put_many(self, model, items):
+        """
+        Store a list of (text, vector) pairs in both tiers with a single disk commit
+        """
+        rows = [(self.get_key(model, text), model, vector) for text, vector in items]
+        with self.lock:
+            for key, _, vector in rows:
+                self._remember(key, vector)
+            if self.connection is not None:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)",
+                    [(key, model, array("f", vector).tobytes()) for key, model, vector in rows])
+                self.connection.commit()
+
+    def get_or_compute(self, model, text, compute):
+        """
+        Get the embedding of the text, calling compute(text) on a cache miss
+        """
+        vector = self.get(model, text)
+        if vector is None:
+            vector = compute(normalize_text(text))
+            self.put(model, text, vector)
+        return vector
+
+    def get_or_compute_many(self, model, texts, compute_batch, max_items=256,
+                            max_tokens=50000, max_workers=4):
+        """
+        Get the embeddings of a list of texts, in input order
+        The texts that are not cached are embedded by compute_batch(list of texts), which
+        must return the vectors in the same order. Misses are packed into batches of at
+        most max_items texts and max_tokens tokens, and up to max_workers batches run
+        concurrently
+        """
+        vectors = [self.get(model, text) for text in texts]
+
+        # each distinct missing text is embedded once
+        missing = list(OrderedDict.fromkeys(
+            normalize_text(text) for text, vector in zip(texts, vectors) if vector is None))
+        if not missing:
+            return vectors
+
+        batches = pack_batches(missing, max_items, max_tokens)
+        computed = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+            for batch, batch_vectors in zip(batches, executor.map(compute_batch, batches)):
+                self.put_many(model, zip(batch, batch_vectors))
+                computed.update(zip(batch, batch_vectors))
+
+        return [vector if vector is not None else computed[normalize_text(text)]
+                for text, vector in zip(texts, vectors)]
+
+    def stats(self):
+        """
+        Get the hit and miss counters
+        """
+        with self.lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses, "memory_items": len(self.memory)}
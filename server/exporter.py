@@ -0,0 +1,106 @@
+"""
+This module exports the facts stored in the Azure blob storage to an OpenAI training file
+"""
+import os
+import json
+import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_newer_than(newer_than):
+    """
+    Parse the --newer-than date sent by the client, None means export everything
+    """
+    if newer_than is None or newer_than == "":
+        return None
+    if isinstance(newer_than, datetime.datetime):
+        cutoff = newer_than
+    else:
+        cutoff = datetime.datetime.fromisoformat(str(newer_than))
+    if cutoff.tzinfo is None:
+        cutoff = cutoff.replace(tzinfo=datetime.timezone.utc)
+    return cutoff
+
+
+def get_newer_than_error(newer_than):
+    """
+    This function returns why a client supplied --newer-than date is invalid, None when it is valid
+    """
+    try:
+        parse_newer_than(newer_than)
+    except (TypeError, ValueError):
+        return f"Invalid --newer-than date {newer_than!r}, use an ISO date like 2023-05-01"
+    return None
+
+
+class TrainingFileExporter:
+    """
+    This class downloads the fact blobs in parallel and streams them to a JSONL file
+    The lines are written in blob listing order, so the output is deterministic, and at
+    most max_pending downloads are held in memory at any time
+    """
+    max_workers = int(os.environ.get("EXPORT_THREADS", "16"))
+    progress_every = 1000
+
+    def __init__(self, azc, max_workers=None, progress=None):
+        self.azc = azc
+        if max_workers is not None:
+            self.max_workers = max_workers
+        self.max_pending = 4 * self.max_workers
+        self.progress = progress or self.print_progress
+
+    @staticmethod
+    def print_progress(count):
+        """
+        Default progress reporter
+        """
+        print(f"Exported {count} facts...")
+
+    @staticmethod
+    def format_fact(fact):
+        """
+        Format a fact as a line of the training file
+        """
+        facttext = {'prompt': fact['prompt'],
+                    'completion': ' '+fact['completion']}
+        return json.dumps(facttext) + "\n"
+
+    def list_blob_names(self, newer_than=None):
+        """
+        List the names of the blobs modified on or after newer_than
+        """
+        cutoff = parse_newer_than(newer_than)
+        for blob in self.azc.get_blob_list():
+            if cutoff is None or blob.last_modified is None or blob.last_modified >= cutoff:
+                yield blob.name
+
+    def download(self, executor, blob_names):
+        """
+        Download the blobs on the executor, yielding the facts in blob_names order
+        """
+        pending = deque()
+        for blob_name in blob_names:
+            pending.append(executor.submit(self.azc.get_json_from_blob, blob_name))
+            if len(pending) >= self.max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    def export(self, filename, newer_than=None):
+        """
+        Write the facts to filename, returns the number of facts written
+        """
+        count = 0
+
+        with open(filename, "w", encoding='utf8') as output_file, \
+                ThreadPoolExecutor(max_workers=self.max_workers,
+                                   thread_name_prefix="export") as executor:
+            for fact in self.download(executor, self.list_blob_names(newer_than)):
+                output_file.write(self.format_fact(fact))
+                count += 1
+                if count % self.progress_every == 0:
+                    self.progress(count)
+
+        return count
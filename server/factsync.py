@@ -0,0 +1,263 @@
+"""
+This module keeps the vector index in sync with the facts file
+Each fact gets an ID derived from a hash of its content, and a local SQLite manifest records
+the IDs that are in the index. A sync streams the file through a pipeline of three stages
+(parse -> embed -> upsert) connected by bounded queues, so memory stays flat whatever the
+size of the file and a slow stage holds back the ones before it. Only new or changed facts
+are embedded and upserted. After every upserted batch the manifest and the byte offset of
+the file are committed together, so an interrupted sync resumes where it stopped. Once the
+whole file was read, the facts that were not seen in it are deleted from the index and the
+index is finalized (the local index is compacted and partitioned once, not per batch)
+"""
+import os
+import json
+import queue
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# IDs per SQL statement, below the SQLite limit of bound parameters
+SQL_CHUNK = 500
+
+
+def fact_id(fact):
+    """
+    Get the content hash ID of a fact, the same fact always gets the same ID
+    """
+    payload = json.dumps(fact, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf8")).hexdigest()
+
+
+def read_facts(path, offset=0):
+    """
+    Read the facts of a JSONL file starting at a byte offset
+    Yields (offset after the fact, fact) tuples, blank lines are skipped
+    """
+    with open(path, "rb") as fact_f:
+        fact_f.seek(offset)
+        for line in fact_f:
+            offset += len(line)
+            if line.strip():
+                yield offset, json.loads(line)
+
+
+def _put(items, item, stop):
+    """
+    Put an item in a bounded queue, waiting for room unless the pipeline is stopped
+    Returns False when the pipeline was stopped
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(items, stop):
+    """
+    Get an item from a queue, None when the pipeline is stopped
+    """
+    while True:
+        try:
+            return items.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return None
+
+
+class FactSync:
+    """
+    This class syncs a facts file to a vector index (PineconeCli or LocalIndexCli)
+    """
+    manifest_path = os.environ.get("FACT_MANIFEST_PATH", "output.manifest.sqlite")
+    # facts per batch, a batch is embedded with one get_embeddings call and upserted at once
+    batch_size = int(os.environ.get("FACT_SYNC_BATCH_SIZE", "1024"))
+    # batches waiting between two stages
+    queue_size = int(os.environ.get("FACT_SYNC_QUEUE_SIZE", "4"))
+
+    def __init__(self, oai, index, manifest_path=None):
+        self.oai = oai
+        self.index = index
+        if manifest_path is not None:
+            self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.manifest_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS facts (id TEXT PRIMARY KEY, model TEXT, run INTEGER)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def _get_state(self):
+        """
+        Get the state of the last sync: index, run, path and offset
+        """
+        with self.lock:
+            return dict(self.connection.execute("SELECT key, value FROM state").fetchall())
+
+    def _set_state(self, **values):
+        """
+        Update the state of the sync, must be called with the lock held, the caller commits
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+            [(key, str(value)) for key, value in values.items()])
+
+    def _start(self, path, index_name):
+        """
+        Start a new run or resume the interrupted one, returns the run and the offset
+        """
+        state = self._get_state()
+        with self.lock:
+            if state.get("index", index_name) != index_name:
+                # the manifest describes another index
+                self.connection.execute("DELETE FROM facts")
+                state = {}
+
+            run = int(state.get("run", "0"))
+            if state.get("path") == path and state.get("offset") and \
+                    int(state["offset"]) <= os.path.getsize(path):
+                offset = int(state["offset"])
+                print(f"Resuming the sync of {path} at byte {offset}")
+            else:
+                run, offset = run + 1, 0
+
+            self._set_state(index=index_name, run=run, path=path, offset=offset)
+            self.connection.commit()
+        return run, offset
+
+    def _indexed(self, ids):
+        """
+        Get the IDs that are already indexed with the current embedding model
+        """
+        indexed = set()
+        with self.lock:
+            for start in range(0, len(ids), SQL_CHUNK):
+                chunk = ids[start:start + SQL_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT id FROM facts WHERE model = ? AND id IN ({placeholders})",
+                    [self.index.embedding_model] + chunk).fetchall()
+                indexed.update(row[0] for row in rows)
+        return indexed
+
+    def _parse_stage(self, path, offset, batches, stop):
+        """
+        Read the file in batches of (end offset, {id: fact}, indexed IDs)
+        """
+        batch = {}
+        end_offset = offset
+        for end_offset, fact in read_facts(path, offset):
+            batch.setdefault(fact_id(fact), fact)
+            if len(batch) >= self.batch_size:
+                if not _put(batches, (end_offset, batch, self._indexed(list(batch))), stop):
+                    return
+                batch = {}
+        if batch or end_offset > offset:
+            if not _put(batches, (end_offset, batch, self._indexed(list(batch))), stop):
+                return
+        _put(batches, None, stop)
+
+    def _embed_stage(self, batches, embedded, stop):
+        """
+        Embed the facts of each batch that are not indexed yet
+        """
+        try:
+            while True:
+                item = _get(batches, stop)
+                if item is None:
+                    break
+                end_offset, batch, indexed = item
+                new_ids = [vector_id for vector_id in batch if vector_id not in indexed]
+                embeddings = self.oai.get_embeddings(
+                    [batch[vector_id]["fact"] for vector_id in new_ids],
+                    self.index.embedding_model) if new_ids else []
+                vectors = [(vector_id, embedding, batch[vector_id])
+                           for vector_id, embedding in zip(new_ids, embeddings)]
+                if not _put(embedded, (end_offset, batch, vectors), stop):
+                    return
+            _put(embedded, None, stop)
+        except Exception:
+            stop.set()
+            raise
+
+    def _upsert_stage(self, embedded, run, index_name, stats, stop):
+        """
+        Upsert the vectors of each batch, then commit the batch and the offset to the manifest
+        """
+        try:
+            while True:
+                item = _get(embedded, stop)
+                if item is None:
+                    break
+                end_offset, batch, vectors = item
+                if vectors:
+                    self.index.upsert_vectors(vectors, index_name)
+
+                with self.lock:
+                    self.connection.executemany(
+                        "INSERT OR REPLACE INTO facts (id, model, run) VALUES (?, ?, ?)",
+                        [(vector_id, self.index.embedding_model, run) for vector_id in batch])
+                    self._set_state(offset=end_offset)
+                    self.connection.commit()
+
+                stats["added"] += len(vectors)
+                stats["unchanged"] += len(batch) - len(vectors)
+        except Exception:
+            stop.set()
+            raise
+
+    def _delete_stale(self, run, index_name):
+        """
+        Delete the facts that were not seen by this run from the index and the manifest
+        """
+        with self.lock:
+            stale = [row[0] for row in self.connection.execute(
+                "SELECT id FROM facts WHERE run != ?", (run,)).fetchall()]
+
+        for start in range(0, len(stale), SQL_CHUNK):
+            chunk = stale[start:start + SQL_CHUNK]
+            self.index.delete_vectors(chunk, index_name)
+            with self.lock:
+                self.connection.execute(
+                    f"DELETE FROM facts WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+                self.connection.commit()
+
+        return len(stale)
+
+    def sync(self, path="output.jsonl", index_name="openai-embeddings"):
+        """
+        Embed and upsert the new facts of the file and delete the removed ones
+        The facts are embedded with the model used for the queries
+        """
+        path = os.path.abspath(path)
+        run, offset = self._start(path, index_name)
+        stats = {"added": 0, "removed": 0, "unchanged": 0}
+
+        batches = queue.Queue(maxsize=self.queue_size)
+        embedded = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="fact-sync") as executor:
+            embed = executor.submit(self._embed_stage, batches, embedded, stop)
+            upsert = executor.submit(self._upsert_stage, embedded, run, index_name, stats, stop)
+            try:
+                self._parse_stage(path, offset, batches, stop)
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                embed.result()
+                upsert.result()
+
+        if stop.is_set():
+            raise RuntimeError("The fact sync was interrupted")
+
+        stats["removed"] = self._delete_stale(run, index_name)
+        self.index.finalize(index_name)
+        with self.lock:
+            self._set_state(offset="")
+            self.connection.commit()
+        return stats
@@ -0,0 +1,22 @@
+"""
+This module selects the vector index backend used for retrieval
+Set VECTOR_INDEX=local to use the in-process index instead of Pinecone
+"""
+import os
+
+VECTOR_INDEX = os.environ.get("VECTOR_INDEX", "pinecone")
+
+
+def get_index_cli(backend=None):
+    """
+    Create the client of the configured vector index backend
+    The backends are imported lazily so that the local index does not need Pinecone
+    """
+    backend = backend or VECTOR_INDEX
+    if backend == "local":
+        from .localindexcli import LocalIndexCli # pylint: disable=import-outside-toplevel
+        return LocalIndexCli()
+    if backend == "pinecone":
+        from .pineconecli import PineconeCli # pylint: disable=import-outside-toplevel
+        return PineconeCli()
+    raise ValueError(f"Unknown vector index backend: {backend}")
@@ -0,0 +1,388 @@
+"""
+This module is an in-process vector index with the same interface as PineconeCli
+The vectors are kept normalized in a NumPy matrix that is persisted to disk and memory
+mapped, so a query is a single matrix product instead of a network round trip.
+Upserts append to the vector file and to a JSONL metadata log, and deletes are logged as
+tombstones, so writing a batch does not depend on the size of the index. finalize compacts
+the files and, for larger corpora, partitions the rows with k-means (IVF) so that a query
+only scores the rows of the partitions closest to it
+"""
+import os
+import json
+import threading
+import numpy as np
+from .openaicli import OpenAICli
+from .retrieval import Retriever
+from . import metrics
+
+
+class LocalIndexCli:
+    """
+    This class is a local drop-in replacement for PineconeCli
+    """
+    index_dir = os.environ.get("LOCAL_INDEX_DIR", "index")
+    # Partition the index once it holds this many vectors, 0 disables partitioning
+    ivf_min_vectors = int(os.environ.get("LOCAL_INDEX_IVF_MIN_VECTORS", "100000"))
+    # Number of partitions scored for each query
+    ivf_nprobe = int(os.environ.get("LOCAL_INDEX_IVF_NPROBE", "8"))
+    ivf_iterations = 10
+    # rows copied at once when the files are rewritten
+    copy_rows = 65536
+    # selects the facts of the prompt from the matches
+    retriever = Retriever()
+    # model used to embed the questions
+    embedding_model = "text-embedding-ada-002"
+
+    def __init__(self, index_dir=None):
+        if index_dir is not None:
+            self.index_dir = index_dir
+        self.oac = OpenAICli()
+        # index name -> loaded index, see _load
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def _paths(self, index_name):
+        """
+        Get the paths of the vector, metadata and partition files of an index
+        The vectors are raw float32 rows and the metadata is a JSONL log, both are appended to
+        """
+        base = os.path.join(self.index_dir, index_name)
+        return base + ".vectors", base + ".jsonl", base + ".ivf.npz"
+
+    @staticmethod
+    def _read_log(meta_path):
+        """
+        Replay the metadata log, returns the dimension, the IDs and metadata of the rows,
+        the deleted rows and the number of log lines
+        A line cut by an interrupted write is truncated so that the next append starts clean
+        """
+        dim, ids, metadata, deleted, lines = 0, [], [], set(), 0
+        with open(meta_path, "r+b") as meta_f:
+            offset = 0
+            for line in meta_f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    meta_f.truncate(offset)
+                    break
+                offset += len(line)
+                lines += 1
+                if "dim" in record:
+                    dim = record["dim"]
+                    continue
+                row = record["row"]
+                if row == len(ids):
+                    ids.append(None)
+                    metadata.append(None)
+                if record.get("deleted"):
+                    ids[row], metadata[row] = None, None
+                    deleted.add(row)
+                else:
+                    ids[row], metadata[row] = record["id"], record["metadata"]
+        return dim, ids, metadata, deleted, lines
+
+    def _map(self, index_name, dim, num_rows):
+        """
+        Memory map the first num_rows rows of the vector file
+        """
+        matrix_path = self._paths(index_name)[0]
+        if num_rows == 0:
+            return np.zeros((0, dim), dtype=np.float32)
+        return np.memmap(matrix_path, dtype=np.float32, mode="r", shape=(num_rows, dim))
+
+    def _load(self, index_name):
+        """
+        Load an index from disk, the vector matrix is memory mapped
+        """
+        with self.lock:
+            index = self.indexes.get(index_name)
+            if index is not None:
+                return index
+
+            matrix_path, meta_path, ivf_path = self._paths(index_name)
+            base = os.path.join(self.index_dir, index_name)
+            if not os.path.exists(meta_path) and os.path.exists(base + ".npy"):
+                self._migrate(index_name, base)
+
+            dim, ids, metadata, deleted, lines = 0, [], [], set(), 0
+            if os.path.exists(meta_path):
+                dim, ids, metadata, deleted, lines = self._read_log(meta_path)
+            if dim and os.path.exists(matrix_path) and \
+                    os.path.getsize(matrix_path) > len(ids) * dim * 4:
+                # rows written before an interruption and never logged
+                os.truncate(matrix_path, len(ids) * dim * 4)
+
+            centroids, assignments = None, None
+            if os.path.exists(ivf_path):
+                with np.load(ivf_path) as ivf:
+                    centroids, assignments = ivf["centroids"], ivf["assignments"]
+
+            index = {"dim": dim, "matrix": self._map(index_name, dim, len(ids)), "ids": ids,
+                     "metadata": metadata, "deleted": deleted, "lines": lines,
+                     "rows": {vector_id: row for row, vector_id in enumerate(ids)
+                              if vector_id is not None},
+                     "centroids": centroids, "assignments": assignments}
+            self.indexes[index_name] = index
+            return index
+
+    def _migrate(self, index_name, base):
+        """
+        Convert an index saved as a .npy matrix and a .json metadata file
+        """
+        matrix = np.load(base + ".npy", mmap_mode="r")
+        with open(base + ".json", "r", encoding="utf8") as meta_f:
+            meta = json.load(meta_f)
+        self._write(index_name, matrix, range(len(meta["ids"])), meta["ids"], meta["metadata"])
+        os.remove(base + ".npy")
+        os.remove(base + ".json")
+
+    def _write(self, index_name, matrix, rows, ids, metadata):
+        """
+        Write the given rows of a matrix as new index files, each file is replaced atomically
+        The rows are copied in chunks so that memory stays flat
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        matrix_path, meta_path, _ = self._paths(index_name)
+        rows = list(rows)
+
+        with open(matrix_path + ".tmp", "wb") as matrix_f:
+            for start in range(0, len(rows), self.copy_rows):
+                chunk = rows[start:start + self.copy_rows]
+                matrix_f.write(np.asarray(matrix[chunk], dtype=np.float32).tobytes())
+        with open(meta_path + ".tmp", "w", encoding="utf8") as meta_f:
+            meta_f.write(json.dumps({"dim": int(matrix.shape[1]) if rows else 0}) + "\n")
+            for new_row, row in enumerate(rows):
+                meta_f.write(json.dumps({"row": new_row, "id": ids[row],
+                                         "metadata": metadata[row]}) + "\n")
+        os.replace(matrix_path + ".tmp", matrix_path)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _partition(self, matrix):
+        """
+        Partition the rows with spherical k-means, returns the centroids and the
+        partition of every row
+        """
+        rng = np.random.default_rng(0)
+        num_lists = max(1, int(np.sqrt(len(matrix))))
+        centroids = np.array(matrix[np.sort(rng.choice(len(matrix), num_lists, replace=False))])
+
+        for _ in range(self.ivf_iterations):
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            for i in range(num_lists):
+                members = matrix[assignments == i]
+                if len(members) > 0:
+                    centroid = members.sum(axis=0)
+                    centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        assignments = np.argmax(matrix @ centroids.T, axis=1)
+        return centroids, assignments
+
+    def upsert_vectors(self, vectors, index_name="openai-embeddings"):
+        """
+        Add or replace (id, embedding, metadata) vectors
+        New rows are appended to the files, so a batch costs the same whatever the size of
+        the index. The rows added since the last finalize are not partitioned and are
+        scored by every query
+        """
+        index = self._load(index_name)
+
+        with self.lock:
+            os.makedirs(self.index_dir, exist_ok=True)
+            matrix_path, meta_path, _ = self._paths(index_name)
+            records = []
+            touched = []
+            if not index["dim"] and vectors:
+                index["dim"] = len(vectors[0][1])
+                records.append({"dim": index["dim"]})
+            row_bytes = index["dim"] * 4
+            num_rows = len(index["ids"])
+
+            mode = "r+b" if os.path.exists(matrix_path) else "w+b"
+            with open(matrix_path, mode) as matrix_f:
+                for vector_id, values, fact in vectors:
+                    values = np.asarray(values, dtype=np.float32)
+                    if len(values) != index["dim"]:
+                        raise ValueError(f"Expected vectors of dimension {index['dim']}, \
+got {len(values)}")
+                    values = values / max(np.linalg.norm(values), 1e-12)
+                    row = index["rows"].get(vector_id)
+                    if row is None:
+                        row = index["rows"][vector_id] = num_rows
+                        num_rows += 1
+                    matrix_f.seek(row * row_bytes)
+                    matrix_f.write(values.tobytes())
+                    records.append({"row": row, "id": vector_id, "metadata": fact})
+                    touched.append(row)
+
+            # the vectors are written first, rows that are not logged are dropped by _load
+            with open(meta_path, "a", encoding="utf8") as meta_f:
+                meta_f.writelines(json.dumps(record) + "\n" for record in records)
+
+            for record in records:
+                if "row" not in record:
+                    continue
+                if record["row"] == len(index["ids"]):
+                    index["ids"].append(None)
+                    index["metadata"].append(None)
+                index["ids"][record["row"]] = record["id"]
+                index["metadata"][record["row"]] = record["metadata"]
+            index["lines"] += len(records)
+            index["matrix"] = self._map(index_name, index["dim"], num_rows)
+
+            if index["centroids"] is not None:
+                # replaced rows move to their closest partition, new rows stay unpartitioned
+                partitioned = [row for row in touched if row < len(index["assignments"])]
+                if partitioned:
+                    index["assignments"][partitioned] = np.argmax(
+                        index["matrix"][partitioned] @ index["centroids"].T, axis=1)
+
+    def delete_vectors(self, ids, index_name="openai-embeddings"):
+        """
+        Delete vectors by ID, the rows are marked as deleted until the next finalize
+        """
+        index = self._load(index_name)
+
+        with self.lock:
+            rows = [index["rows"].pop(vector_id) for vector_id in ids
+                    if vector_id in index["rows"]]
+            if not rows:
+                return
+            meta_path = self._paths(index_name)[1]
+            with open(meta_path, "a", encoding="utf8") as meta_f:
+                meta_f.writelines(json.dumps({"row": row, "deleted": True}) + "\n"
+                                  for row in rows)
+            for row in rows:
+                index["ids"][row], index["metadata"][row] = None, None
+                index["deleted"].add(row)
+            index["lines"] += len(rows)
+
+    def finalize(self, index_name="openai-embeddings"):
+        """
+        Compact the files of an index and rebuild its partitions, called once a sync
+        has written all its batches
+        """
+        index = self._load(index_name)
+
+        with self.lock:
+            _, _, ivf_path = self._paths(index_name)
+            # the log has a header line and one line per row when it is compact
+            if index["deleted"] or index["lines"] > len(index["ids"]) + 1:
+                live = [row for row in range(len(index["ids"])) if row not in index["deleted"]]
+                self._write(index_name, index["matrix"], live, index["ids"], index["metadata"])
+                index["ids"] = [index["ids"][row] for row in live]
+                index["metadata"] = [index["metadata"][row] for row in live]
+                index["rows"] = {vector_id: row for row, vector_id in enumerate(index["ids"])}
+                index["deleted"] = set()
+                index["lines"] = len(live) + 1
+                index["matrix"] = self._map(index_name, index["dim"], len(live))
+
+            if 0 < self.ivf_min_vectors <= len(index["ids"]):
+                centroids, assignments = self._partition(index["matrix"])
+                with open(ivf_path + ".tmp", "wb") as ivf_f:
+                    np.savez(ivf_f, centroids=centroids, assignments=assignments)
+                os.replace(ivf_path + ".tmp", ivf_path)
+                index["centroids"], index["assignments"] = centroids, assignments
+            else:
+                if os.path.exists(ivf_path):
+                    os.remove(ivf_path)
+                index["centroids"], index["assignments"] = None, None
+
+    def _query_many(self, query_vectors, n, index_name):
+        """
+        Find the n closest vectors to each query, the results have the same shape
+        as the results of a Pinecone query
+        """
+        with metrics.timed("index_query", "local"):
+            return self._score(query_vectors, n, index_name)
+
+    def _score(self, query_vectors, n, index_name):
+        """
+        Score the queries against the index and keep the n best matches of each
+        """
+        index = self._load(index_name)
+        matrix = index["matrix"]
+        if len(matrix) == 0:
+            return [{"matches": []} for _ in query_vectors]
+
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        if index["centroids"] is None:
+            candidates = [None] * len(queries)
+            scores = queries @ matrix.T
+        else:
+            # only score the rows of the partitions closest to each query
+            nprobe = min(self.ivf_nprobe, len(index["centroids"]))
+            probes = np.argsort(-(queries @ index["centroids"].T), axis=1)[:, :nprobe]
+            # the rows added since the last partitioning are always scored
+            unpartitioned = np.arange(len(index["assignments"]), len(matrix))
+            candidates = [np.concatenate([np.flatnonzero(np.isin(index["assignments"], probe)),
+                                          unpartitioned]) for probe in probes]
+            scores = [matrix[rows] @ query for rows, query in zip(candidates, queries)]
+
+        results = []
+        for rows, row_scores in zip(candidates, scores):
+            # deleted rows stay in the matrix until the next finalize and are skipped
+            top = min(n + len(index["deleted"]), len(row_scores))
+            if top == 0:
+                results.append({"matches": []})
+                continue
+            best = np.argpartition(-row_scores, top - 1)[:top]
+            best = best[np.argsort(-row_scores[best])]
+            matches = []
+            for position in best:
+                row = int(position if rows is None else rows[position])
+                if index["ids"][row] is None:
+                    continue
+                if len(matches) == n:
+                    break
+                matches.append({"id": index["ids"][row], "score": float(row_scores[position]),
+                                "metadata": index["metadata"][row], "values": matrix[row]})
+            results.append({"matches": matches})
+
+        return results
+
+    def _query(self, query_vector, n, index_name):
+        """
+        Find the n closest vectors to the query
+        """
+        return self._query_many([query_vector], n, index_name)[0]
+
+    def find_matches(self, text, n=None, index_name="openai-embeddings"):
+        """
+        Find the facts that match the text in the local index, see Retriever.select
+        """
+        query_vector = self.oac.get_embedding(text, self.embedding_model)
+        results = self._query(query_vector, n or self.retriever.top_k, index_name)
+        return self.retriever.select(query_vector, results['matches'])
+
+    async def afind_matches(self, text, n=None, index_name="openai-embeddings"):
+        """
+        This is the asyncio version of find_matches, only the embedding call is awaited
+        since the query itself is an in-memory matrix product
+        """
+        query_vector = await self.oac.aget_embedding(text, self.embedding_model)
+        results = self._query(query_vector, n or self.retriever.top_k, index_name)
+        return self.retriever.select(query_vector, results['matches'])
+
+    def find_matches_many(self, texts, n=None, index_name="openai-embeddings"):
+        """
+        Find the facts that match each of the texts, the texts are embedded together
+        and scored with a single matrix product
+        """
+        query_vectors = self.oac.get_embeddings(texts, self.embedding_model)
+        results = self._query_many(query_vectors, n or self.retriever.top_k, index_name)
+        return [self.retriever.select(query_vector, result['matches'])
+                for query_vector, result in zip(query_vectors, results)]
+
+    def find_match(self, text, n=None, index_name="openai-embeddings"):
+        """
+        Find the closest match in the local index
+        """
+        return self.retriever.format(self.find_matches(text, n, index_name))
+
+    async def afind_match(self, text, n=None, index_name="openai-embeddings"):
+        """
+        This is the asyncio version of find_match
+        """
+        return self.retriever.format(await self.afind_matches(text, n, index_name))
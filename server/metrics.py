@@ -0,0 +1,176 @@
+"""
+This module collects latency and token metrics and renders them in the Prometheus
+text exposition format for the /metrics endpoint
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from cache hits to slow completions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    """
+    Format a label set as {name="value",...}
+    """
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    """
+    This class is a counter with labels
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Increment the counter of a label set
+        """
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        """
+        Render the counter in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    This class is a histogram with labels
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label set -> [count per bucket, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Add an observation to the histogram of a label set
+        """
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        """
+        Render the histogram in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (bucket_counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = _format_labels(self.labelnames, key, ("le", repr(bound)))
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labelnames, key, ("le", "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "chatbot_request_seconds", "Time to handle a client request", ("command",))
+REQUESTS = Counter(
+    "chatbot_requests_total", "Client requests handled", ("command", "status"))
+STAGE_SECONDS = Histogram(
+    "chatbot_stage_seconds", "Time spent in each stage of a request", ("stage", "model"))
+STAGE_ERRORS = Counter(
+    "chatbot_stage_errors_total", "Stages that raised an error", ("stage", "model"))
+TOKENS = Counter(
+    "chatbot_tokens_total", "Tokens used by the completion API", ("model", "kind"))
+RESPONSE_CACHE = Counter(
+    "chatbot_response_cache_total", "Response cache lookups", ("result",))
+SEARCH_CACHE = Counter(
+    "chatbot_search_cache_total", "Search cache lookups", ("result",))
+RETRIES = Counter(
+    "chatbot_upstream_retries_total", "Upstream calls retried after an error", ("stage", "model"))
+HEDGES = Counter(
+    "chatbot_upstream_hedges_total", "Duplicate requests sent for slow calls", ("stage", "model"))
+
+METRICS = [REQUEST_SECONDS, REQUESTS, STAGE_SECONDS, STAGE_ERRORS, TOKENS, RESPONSE_CACHE,
+           SEARCH_CACHE, RETRIES, HEDGES]
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@contextmanager
+def timed(stage, model=""):
+    """
+    Time the body of the with statement as a stage of the request
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage, model=model)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage, model=model)
+
+
+def observe_stage(stage, seconds, model=""):
+    """
+    Record the duration of a stage that was timed by the caller
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage, model=model)
+
+
+def record_usage(model, usage):
+    """
+    Record the token usage reported by a completion response
+    """
+    if not usage:
+        return
+    TOKENS.inc(usage.get("prompt_tokens", 0), model=model, kind="prompt")
+    TOKENS.inc(usage.get("completion_tokens", 0), model=model, kind="completion")
+
+
+def record_request(command, seconds, status="ok"):
+    """
+    Record a client request
+    """
+    REQUEST_SECONDS.observe(seconds, command=command)
+    REQUESTS.inc(command=command, status=status)
+
+
+def render():
+    """
+    Render all the metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
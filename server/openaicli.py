@@ -1,7 +1,13 @@
 """
 This module is used to interact with the OpenAI API
 """
+import os
+import time
 from openai import Embedding, Image, ChatCompletion
+from .embeddingcache import EmbeddingCache, normalize_text
+from .scheduler import RequestScheduler, estimate_tokens, is_retryable
+from .router import ModelRouter
+from . import metrics
 
 class OpenAICli:
     """
@@ -13,7 +19,20 @@ class OpenAICli:
     presence_penalty=0.0 
     model="gpt-3.5-turbo-0301"
     impage_size="1024x1024"
-    
+    # Offer the tools through the function calling API, the model must support it
+    # (gpt-3.5-turbo-0301 does not, the tools are then invoked with $tool() in the text)
+    function_calling = os.environ.get("OPENAI_FUNCTION_CALLING", "0") == "1"
+    # shared by every client so that all embedding callers go through the same cache
+    embedding_cache = EmbeddingCache()
+    # shared by every client so that all calls count against the same rate limits
+    scheduler = RequestScheduler()
+    # picks the model of each completion, model is the default of every route
+    router = ModelRouter(model)
+    # limits for one Embedding request, and the number of requests sent concurrently
+    embedding_batch_size = int(os.environ.get("EMBEDDING_BATCH_SIZE", "256"))
+    embedding_batch_tokens = int(os.environ.get("EMBEDDING_BATCH_TOKENS", "50000"))
+    embedding_threads = int(os.environ.get("EMBEDDING_THREADS", "4"))
+
     def __init__(self):
         return
 
@@ -21,40 +40,265 @@ class OpenAICli:
         """
         This function is used to generate an image from a piece of text
         """
-        response = Image.create(prompt=text, n=2, size=self.impage_size)
+        response = self.scheduler.call(
+            lambda: Image.create(prompt=text, n=2, size=self.impage_size), "image", kind="image")
         return response.data[0].url
 
-    def get_response(self, messages):
+    def _completion_args(self, model, messages, tools=None, stream=False):
+        """
+        Build the arguments of a ChatCompletion request
+        """
+        args = {
+            "model": model,
+            "messages": messages,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "frequency_penalty": self.frequency_penalty,
+            "presence_penalty": self.presence_penalty,
+        }
+        if tools:
+            args["tools"] = tools
+        if stream:
+            args["stream"] = True
+        return args
+
+    @staticmethod
+    def _read_message(message, tool_calls):
+        """
+        Get the text of a completion message, its function calls are appended to tool_calls
+        as (id, name, arguments) tuples
+        """
+        if tool_calls is not None:
+            for call in message.get("tool_calls") or []:
+                tool_calls.append(
+                    (call["id"], call["function"]["name"], call["function"]["arguments"]))
+        return (message.get("content") or "").strip()
+
+    @staticmethod
+    def _read_tool_call_deltas(delta, pending):
+        """
+        Accumulate the pieces of the streamed function calls of a chunk in pending,
+        a dict of call index -> [id, name, arguments]
+        """
+        for part in delta.get("tool_calls") or []:
+            call = pending.setdefault(part.get("index", 0), ["", "", ""])
+            function = part.get("function") or {}
+            call[0] += part.get("id") or ""
+            call[1] += function.get("name") or ""
+            call[2] += function.get("arguments") or ""
+
+    def _fallback(self, model, models, err, elapsed):
+        """
+        Record a failed call, returns True when the next model of the route should be tried
+        Errors that are not transient (a bad request) would fail on every model
+        """
+        if not is_retryable(err):
+            return False
+        self.router.record(model, elapsed, failed=True)
+        if model == models[-1]:
+            return False
+        print(f"Call to {model} failed, falling back to the next model:", err)
+        return True
+
+    def _call_routed(self, call_type, messages, request):
+        """
+        Call request(model, prompt tokens) on the models of the route until one succeeds
+        Returns the model that answered and the result
+        """
+        tokens = estimate_tokens(messages)
+        models = self.router.get_models(call_type, tokens)
+        for model in models:
+            start = time.perf_counter()
+            try:
+                result = request(model, tokens)
+            except Exception as err: # pylint: disable=broad-except
+                if not self._fallback(model, models, err, time.perf_counter() - start):
+                    raise
+                continue
+            self.router.record(model, time.perf_counter() - start)
+            return model, result
+
+    async def _acall_routed(self, call_type, messages, request):
+        """
+        This is the asyncio version of _call_routed, request must return an awaitable
+        """
+        tokens = estimate_tokens(messages)
+        models = self.router.get_models(call_type, tokens)
+        for model in models:
+            start = time.perf_counter()
+            try:
+                result = await request(model, tokens)
+            except Exception as err: # pylint: disable=broad-except
+                if not self._fallback(model, models, err, time.perf_counter() - start):
+                    raise
+                continue
+            self.router.record(model, time.perf_counter() - start)
+            return model, result
+
+    def get_response(self, messages, tools=None, tool_calls=None, call_type="answer",
+                     models=None):
         """
         This the main function to send the chat context to the GPT model and get a response.
+        When tools (see Tools.get_functions) are given the model may call them, the calls
+        are appended to the tool_calls list as (id, name, arguments) tuples.
+        The model is picked by the router for the call type (answer, summarize or tool),
+        the model that answered is appended to the models list
         """
-        response = ChatCompletion.create(
-            model=self.model,
-            messages=messages,
-            temperature=self.temperature,
-            top_p=self.top_p,
-            frequency_penalty=self.frequency_penalty,
-            presence_penalty=self.presence_penalty)
+        def request(model, tokens):
+            with metrics.timed("completion", model):
+                args = self._completion_args(model, messages, tools)
+                return self.scheduler.call(
+                    lambda: ChatCompletion.create(**args), model, tokens=tokens, hedge=True)
 
-        return response.choices[0].message.content.strip()
+        model, response = self._call_routed(call_type, messages, request)
+        metrics.record_usage(model, response.get("usage"))
+        if models is not None:
+            models.append(model)
+
+        return self._read_message(response.choices[0].message, tool_calls)
+
+    def get_response_stream(self, messages, tools=None, tool_calls=None, call_type="answer",
+                            models=None):
+        """
+        This function streams the response from the GPT model. Tokens are yielded
+        as soon as they arrive instead of waiting for the whole completion.
+        The function calls are assembled from the streamed pieces and appended to the
+        tool_calls list once the stream ends. A fallback model is only tried when the
+        stream cannot be opened
+        """
+        def request(model, tokens):
+            with metrics.timed("completion_open", model):
+                args = self._completion_args(model, messages, tools, stream=True)
+                return self.scheduler.call(
+                    lambda: ChatCompletion.create(**args), model, tokens=tokens)
+
+        start = time.perf_counter()
+        chunks = 0
+        pending = {}
+        model, response = self._call_routed(call_type, messages, request)
+        if models is not None:
+            models.append(model)
+        with metrics.timed("completion_stream", model):
+            for chunk in response:
+                delta = chunk.choices[0].delta
+                self._read_tool_call_deltas(delta, pending)
+                token = delta.get("content")
+                if token:
+                    if chunks == 0:
+                        metrics.observe_stage("completion_first_token",
+                                              time.perf_counter() - start, model)
+                    # streamed responses carry no usage, each chunk is one token
+                    chunks += 1
+                    yield token
+        metrics.TOKENS.inc(chunks, model=model, kind="completion")
+        if tool_calls is not None:
+            tool_calls.extend(tuple(pending[index]) for index in sorted(pending))
+
+    async def aget_response(self, messages, tools=None, tool_calls=None, call_type="answer",
+                            models=None):
+        """
+        This is the asyncio version of get_response
+        """
+        async def request(model, tokens):
+            with metrics.timed("completion", model):
+                args = self._completion_args(model, messages, tools)
+                return await self.scheduler.acall(
+                    lambda: ChatCompletion.acreate(**args), model, tokens=tokens, hedge=True)
+
+        model, response = await self._acall_routed(call_type, messages, request)
+        metrics.record_usage(model, response.get("usage"))
+        if models is not None:
+            models.append(model)
+
+        return self._read_message(response.choices[0].message, tool_calls)
+
+    async def aget_response_stream(self, messages, tools=None, tool_calls=None,
+                                   call_type="answer", models=None):
+        """
+        This is the asyncio version of get_response_stream
+        """
+        async def request(model, tokens):
+            with metrics.timed("completion_open", model):
+                args = self._completion_args(model, messages, tools, stream=True)
+                return await self.scheduler.acall(
+                    lambda: ChatCompletion.acreate(**args), model, tokens=tokens)
+
+        start = time.perf_counter()
+        chunks = 0
+        pending = {}
+        model, response = await self._acall_routed(call_type, messages, request)
+        if models is not None:
+            models.append(model)
+        with metrics.timed("completion_stream", model):
+            async for chunk in response:
+                delta = chunk.choices[0].delta
+                self._read_tool_call_deltas(delta, pending)
+                token = delta.get("content")
+                if token:
+                    if chunks == 0:
+                        metrics.observe_stage("completion_first_token",
+                                              time.perf_counter() - start, model)
+                    # streamed responses carry no usage, each chunk is one token
+                    chunks += 1
+                    yield token
+        metrics.TOKENS.inc(chunks, model=model, kind="completion")
+        if tool_calls is not None:
+            tool_calls.extend(tuple(pending[index]) for index in sorted(pending))
 
     def get_response_from_text(self, text):
         """
         This function is used when you need a response for a single piece of text
         """
-
-        response = ChatCompletion.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": f"{text}"},
-            ])
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": f"{text}"},
+        ]
+        response = self.scheduler.call(
+            lambda: ChatCompletion.create(model=self.model, messages=messages), self.model,
+            tokens=estimate_tokens(messages), hedge=True)
 
         return response.choices[0].message.content.strip()
 
     def get_embedding(self, text, model="text-similarity-davinci-001"):
         """
         This function is used to generate an embedding vector for a piece of text
+        Vectors are served from the embedding cache when the text was seen before
+        """
+        return self.embedding_cache.get_or_compute(
+            model, text, lambda text: self._create_embeddings([text], model)[0])
+
+    def _create_embeddings(self, texts, model):
+        """
+        Embed a batch of texts with one request, the vectors are returned in input order
+        """
+        with metrics.timed("embedding", model):
+            response = self.scheduler.call(
+                lambda: Embedding.create(input=texts, model=model), model, kind="embedding",
+                tokens=estimate_tokens(texts), hedge=True)
+        return [item['embedding'] for item in sorted(response['data'], key=lambda d: d['index'])]
+
+    def get_embeddings(self, texts, model="text-similarity-davinci-001"):
+        """
+        This function is used to generate the embedding vectors for a list of texts
+        Uncached texts are sent in batches, several batches at a time, and the vectors
+        are returned in the order of the texts
+        """
+        return self.embedding_cache.get_or_compute_many(
+            model, texts, lambda batch: self._create_embeddings(batch, model),
+            max_items=self.embedding_batch_size, max_tokens=self.embedding_batch_tokens,
+            max_workers=self.embedding_threads)
+
+    async def aget_embedding(self, text, model="text-similarity-davinci-001"):
+        """
+        This is the asyncio version of get_embedding
         """
-        text = text.replace("\n", " ")
-        return Embedding.create(input=[text], model=model)['data'][0]['embedding']
+        vector = self.embedding_cache.get(model, text)
+        if vector is None:
+            with metrics.timed("embedding", model):
+                texts = [normalize_text(text)]
+                response = await self.scheduler.acall(
+                    lambda: Embedding.acreate(input=texts, model=model), model,
+                    kind="embedding", tokens=estimate_tokens(texts), hedge=True)
+            vector = response['data'][0]['embedding']
+            self.embedding_cache.put(model, text, vector)
+        return vector
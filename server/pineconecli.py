@@ -2,40 +2,211 @@
 This module is a helper library to connect to the Pinecone API
 """
 import os
+import json
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pinecone import init, Index
+from urllib3 import exceptions as http_errors
 from .openaicli import OpenAICli
+from .retrieval import Retriever
+from . import metrics
 
 
 class PineconeCli:
     """
     This class is used to interact with the Pinecone API
     """
-    def __init__(self):
+    # model used to embed the questions
+    embedding_model = "text-embedding-ada-002"
+    # The Pinecone client is blocking, the asyncio methods run its calls on these threads
+    executor = ThreadPoolExecutor(
+        max_workers=int(os.environ.get("PINECONE_QUERY_THREADS", "64")),
+        thread_name_prefix="pinecone")
+    # selects the facts of the prompt from the matches
+    retriever = Retriever()
+    # Upserts are split in chunks under the request size limit of Pinecone (2MB, 1000
+    # vectors), several chunks are sent at a time and a failed chunk is retried
+    upsert_batch_size = int(os.environ.get("PINECONE_UPSERT_BATCH_SIZE", "100"))
+    upsert_max_bytes = int(os.environ.get("PINECONE_UPSERT_MAX_BYTES", str(2 * 1000 * 1000)))
+    upsert_threads = int(os.environ.get("PINECONE_UPSERT_THREADS", "8"))
+    upsert_retries = int(os.environ.get("PINECONE_UPSERT_RETRIES", "3"))
+    progress_every = 10000
+
+    def __init__(self, progress=None):
         # Set up Pinecone API credentials
         init(api_key=os.getenv("PINECONE_API_KEY"), environment="us-east1-gcp")
         self.oac = OpenAICli()
+        # index name -> Index, each handle keeps its own connection pool
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.progress = progress or self.print_progress
+
+    @staticmethod
+    def print_progress(count, total):
+        """
+        Default progress reporter
+        """
+        print(f"Upserted {count}/{total} vectors...")
+
+    def get_index(self, index_name):
+        """
+        Get the handle of an index, it is created on first use and reused by every call
+        """
+        with self.lock:
+            pinecone_index = self.indexes.get(index_name)
+            if pinecone_index is None:
+                pinecone_index = self.indexes[index_name] = Index(index_name=index_name)
+            return pinecone_index
+
+    @staticmethod
+    def _vector_size(vector):
+        """
+        Estimate the size of a vector in the JSON body of an upsert request
+        """
+        vector_id, values, metadata = vector
+        return len(vector_id) + 12 * len(values) + len(json.dumps(metadata)) + 32
+
+    def _chunks(self, vectors):
+        """
+        Split the vectors in chunks of at most upsert_batch_size vectors and
+        upsert_max_bytes bytes, a vector larger than the limit gets a chunk of its own
+        """
+        chunk = []
+        chunk_bytes = 0
+        for vector in vectors:
+            size = self._vector_size(vector)
+            if chunk and (len(chunk) >= self.upsert_batch_size or
+                          chunk_bytes + size > self.upsert_max_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(vector)
+            chunk_bytes += size
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _is_retryable(err):
+        """
+        Check if a failed Pinecone call may be retried: rate limiting, server errors, and
+        connection errors and timeouts. Anything else (a client error, a bad vector)
+        would fail again
+        """
+        if isinstance(err, (ConnectionError, TimeoutError, http_errors.TimeoutError,
+                            http_errors.ProtocolError, http_errors.MaxRetryError,
+                            http_errors.NewConnectionError)):
+            return True
+        status = getattr(err, "status", None)
+        return isinstance(status, int) and (status == 429 or status >= 500)
+
+    def _upsert_chunk(self, chunk, index_name):
+        """
+        Upsert a chunk of vectors, retrying transient errors with jittered backoff
+        """
+        pinecone_index = self.get_index(index_name)
+        for attempt in range(self.upsert_retries + 1):
+            try:
+                with metrics.timed("index_upsert", "pinecone"):
+                    pinecone_index.upsert(vectors=chunk)
+                return len(chunk)
+            except Exception as err: # pylint: disable=broad-except
+                if attempt == self.upsert_retries or not self._is_retryable(err):
+                    raise
+                print(f"Retrying the upsert of {len(chunk)} vectors after error:", err)
+                metrics.RETRIES.inc(stage="index_upsert", model="pinecone")
+                time.sleep(random.uniform(0, min(30, 0.5 * 2 ** attempt)))
+        return 0
 
     def upsert_vectors(self, vectors, index_name="openai-embeddings"):
         """
         Upload the embeddings to Pinecone
+        The vectors are sent in chunks, upsert_threads chunks at a time
         """
-        pinecone_index = Index(index_name=index_name)
+        total = len(vectors)
+        count = 0
+        reported = 0
+        pending = []
+        with ThreadPoolExecutor(max_workers=self.upsert_threads,
+                                thread_name_prefix="pinecone-upsert") as executor:
+            for chunk in self._chunks(vectors):
+                pending.append(executor.submit(self._upsert_chunk, chunk, index_name))
+                # keep a bounded number of chunks in flight
+                if len(pending) >= 2 * self.upsert_threads:
+                    count += pending.pop(0).result()
+                    if count - reported >= self.progress_every:
+                        reported = count
+                        self.progress(count, total)
+            for future in pending:
+                count += future.result()
 
-        # Store the embeddings and associated facts in Pinecone
-        pinecone_index.upsert(vectors=vectors)
+        if total >= self.progress_every:
+            self.progress(count, total)
+        return count
 
-    def find_match(self, text, n=10, index_name="openai-embeddings"):
+    def delete_vectors(self, ids, index_name="openai-embeddings", batch_size=1000):
         """
-        Find the closest match in Pinecone
+        Delete vectors from Pinecone by ID
         """
-        pinecone_index = Index(index_name=index_name)
-        query_vector = self.oac.get_embedding(text, "text-embedding-ada-002")
-        results = pinecone_index.query(vector=query_vector, top_k=n, include_metadata=True)
+        pinecone_index = self.get_index(index_name)
+        for start in range(0, len(ids), batch_size):
+            pinecone_index.delete(ids=list(ids[start:start + batch_size]))
 
-        match = ""
+    def finalize(self, index_name="openai-embeddings"):
+        """
+        Nothing to do once a sync is written, Pinecone indexes the vectors as they come
+        """
+
+    def _query(self, query_vector, n, index_name):
+        """
+        Query Pinecone for the closest vectors, the values of the vectors are only
+        returned when the retriever reranks them with MMR
+        """
+        with metrics.timed("index_query", "pinecone"):
+            pinecone_index = self.get_index(index_name)
+            return pinecone_index.query(vector=query_vector, top_k=n, include_metadata=True,
+                                        include_values=self.retriever.mmr)
 
-        for result in results['matches']:
-            if result['score'] > 0.7:
-                match += result['metadata']['fact'] + "\n"
+    def find_matches(self, text, n=None, index_name="openai-embeddings"):
+        """
+        Find the facts that match the text in Pinecone, see Retriever.select
+        """
+        query_vector = self.oac.get_embedding(text, self.embedding_model)
+        results = self._query(query_vector, n or self.retriever.top_k, index_name)
+        return self.retriever.select(query_vector, results['matches'])
+
+    async def afind_matches(self, text, n=None, index_name="openai-embeddings"):
+        """
+        This is the asyncio version of find_matches
+        """
+        query_vector = await self.oac.aget_embedding(text, self.embedding_model)
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(
+            self.executor, self._query, query_vector, n or self.retriever.top_k, index_name)
+        return self.retriever.select(query_vector, results['matches'])
 
-        return match
+    def find_matches_many(self, texts, n=None, index_name="openai-embeddings"):
+        """
+        Find the facts that match each of the texts, the texts are embedded together
+        and the queries run concurrently
+        """
+        query_vectors = self.oac.get_embeddings(texts, self.embedding_model)
+        n = n or self.retriever.top_k
+        results = self.executor.map(
+            lambda query_vector: self._query(query_vector, n, index_name), query_vectors)
+        return [self.retriever.select(query_vector, result['matches'])
+                for query_vector, result in zip(query_vectors, results)]
+
+    def find_match(self, text, n=None, index_name="openai-embeddings"):
+        """
+        Find the closest match in Pinecone
+        """
+        return self.retriever.format(self.find_matches(text, n, index_name))
+
+    async def afind_match(self, text, n=None, index_name="openai-embeddings"):
+        """
+        This is the asyncio version of find_match
+        """
+        return self.retriever.format(await self.afind_matches(text, n, index_name))
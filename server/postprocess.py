@@ -0,0 +1,108 @@
+"""
+This module post-processes the responses before they are sent to the client
+Fenced code blocks (```language ... ```) are found with a regular expression and only those
+segments are highlighted. The lexers, the formatter and the CSS are created once and reused
+"""
+import re
+import html
+from enum import Enum
+from functools import lru_cache
+from pygments import highlight
+from pygments.lexers import get_lexer_by_name
+from pygments.lexers.special import TextLexer
+from pygments.formatters.html import HtmlFormatter
+from pygments.util import ClassNotFound
+from . import metrics
+
+# A fenced code block, the closing fence is optional so a truncated answer still renders
+CODE_FENCE = re.compile(r"```[ \t]*([^\s`]*)[^\n]*\n(.*?)(?:```|\Z)", re.DOTALL)
+
+FORMATTER = HtmlFormatter()
+
+
+class ResponseType(Enum):
+    """
+    The type of a response, it tells the client how to render the text
+    Text -- plain text
+    Code -- a single code block, the raw code that the client highlights
+    Mixed -- prose and code blocks, formatted as an HTML document
+    """
+    Text = "Text"
+    Code = "Code"
+    Mixed = "Mixed"
+
+
+@lru_cache(maxsize=None)
+def get_style():
+    """
+    Get the CSS rules of the highlighted code
+    """
+    return FORMATTER.get_style_defs(".highlight")
+
+
+@lru_cache(maxsize=64)
+def get_lexer(language):
+    """
+    Get the lexer of a language, unknown or missing languages are not highlighted
+    """
+    try:
+        return get_lexer_by_name(language or "text")
+    except ClassNotFound:
+        return TextLexer()
+
+
+def split_segments(text):
+    """
+    Split the text into (language, content) segments, language is None for prose and
+    an empty string for a code block without a language
+    """
+    segments = []
+    position = 0
+    for match in CODE_FENCE.finditer(text):
+        prose = text[position:match.start()]
+        if prose.strip():
+            segments.append((None, prose.strip("\n")))
+        segments.append((match.group(1).lower(), match.group(2)))
+        position = match.end()
+
+    rest = text[position:]
+    if rest.strip():
+        segments.append((None, rest.strip("\n")))
+
+    return segments
+
+
+def format_segments(segments):
+    """
+    Format the segments as an HTML document, the code blocks are highlighted
+    """
+    parts = []
+    for language, content in segments:
+        if language is None:
+            parts.append(f'<div class="text">{html.escape(content)}</div>')
+        else:
+            parts.append(highlight(content, get_lexer(language), FORMATTER))
+
+    body = "\n".join(parts)
+    return f"<html><head><style>\n{get_style()}\n.text {{ white-space: pre-wrap; }}\n\
+</style></head>\n<body>\n{body}\n</body></html>"
+
+
+def postprocess(text):
+    """
+    Get the type of a response and the text to send to the client
+    Responses without a code fence are returned as-is without further parsing
+    A single code block is returned as the raw code, the client highlights it and copies it
+    """
+    with metrics.timed("postprocess"):
+        if "```" not in text:
+            return ResponseType.Text, text
+
+        segments = split_segments(text)
+        if all(language is None for language, _ in segments):
+            return ResponseType.Text, text
+
+        if len(segments) == 1:
+            return ResponseType.Code, segments[0][1]
+
+        return ResponseType.Mixed, format_segments(segments)
@@ -26,11 +26,11 @@ CHAT_QA_HISTORY = [
 CHAT_Q = [
     {"role": "system", "content": "this is some context for the conversation: {standard_context}"},
     {"role": "system", "content": "Ask me any question you have. If I am unable to answer \
-     your question, I will prompt you to perform a search by including the $search() \
-     function in your response. I will place the search term inside the parentheses, \
-     like this: $search(search term). This will ensure that I can reliably prompt you \
-     to search for information. Thank you! I will not give up without at least \
-     attempting a search."},
+     your question, I will prompt you to use one of the tools below by including its \
+     invocation in your response. I will place the parameter of the tool inside the \
+     parentheses, like this: $search(search term), and leave them empty for a tool \
+     without a parameter. This will ensure that I can reliably prompt you to use the \
+     tools. Thank you! I will not give up without at least attempting a search.\n{tools}"},
     {"role": "user", "content": "Question: {question}"},
 ]
 
@@ -86,6 +86,21 @@ class Prompt:
              .format(question=question, answer=answer)} for blob in CHAT_QA_HISTORY]
         return formatted_qa_history
 
+    def get_tool_calls_prompt(self, content, function_calls):
+        """
+        This function returns the assistant message that requested the (id, name, arguments)
+        function calls, it must be followed by one tool message per call
+        """
+        return [{"role": "assistant", "content": content or None, "tool_calls": [
+            {"id": call_id, "type": "function", "function": {"name": name, "arguments": arguments}}
+            for call_id, name, arguments in function_calls]}]
+
+    def get_tool_output_prompt(self, call_id, output):
+        """
+        This function returns the tool message with the output of a function call
+        """
+        return [{"role": "tool", "tool_call_id": call_id, "content": output}]
+
     def get_context_prompt(self, context):
         """
         This function returns the context prompt
@@ -95,13 +110,14 @@ class Prompt:
              .format(context=context)} for blob in CHAT_CONTEXT]
         return formatted_chat_context
 
-    def get_q_prompt(self, question, standard_context):
+    def get_q_prompt(self, question, standard_context, tools=""):
         """
-        This function returns the Q prompt
+        This function returns the Q prompt, tools lists the $tool(parameter) invocations
         """
         formatted_chat_q = [
             {"role": blob["role"], "content": blob["content"]
-             .format(question=question, standard_context=standard_context)} for blob in CHAT_Q]
+             .format(question=question, standard_context=standard_context, tools=tools)}
+            for blob in CHAT_Q]
         return formatted_chat_q
 
     def get_summarize_conversation_prompt(self):
@@ -0,0 +1,139 @@
+"""
+This module contains the semantic response cache that sits in front of the completion API
+An answer is reused when a new question is close enough (cosine similarity of the question
+embeddings) to a cached question that was answered with the same retrieved context and the
+same model parameters
+"""
+import os
+import re
+import math
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from . import metrics
+
+# Questions with these words usually refer to earlier turns of the conversation
+HISTORY_REFERENCE = re.compile(
+    r"\b(it|its|that|this|those|these|they|them|he|she|him|her|his|hers|their|"
+    r"above|previous|earlier|again|more|else|same)\b", re.IGNORECASE)
+
+
+def _normalize(vector):
+    """
+    Scale a vector to unit length
+    """
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+class ResponseCache:
+    """
+    This class caches answers keyed on the question embedding, the retrieved context hash
+    and the model parameters. Entries expire after ttl seconds and the least recently used
+    entries are evicted when the cache holds more than max_entries entries or max_bytes
+    bytes of answers. The cache is opt-in: set RESPONSE_CACHE_ENABLED=1
+    """
+    enabled = os.environ.get("RESPONSE_CACHE_ENABLED", "0") == "1"
+    threshold = float(os.environ.get("RESPONSE_CACHE_THRESHOLD", "0.95"))
+    ttl = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+    max_entries = int(os.environ.get("RESPONSE_CACHE_SIZE", "1000"))
+    max_bytes = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(10 * 1024 * 1024)))
+
+    def __init__(self, enabled=None, threshold=None, ttl=None, max_entries=None, max_bytes=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if threshold is not None:
+            self.threshold = threshold
+        if ttl is not None:
+            self.ttl = ttl
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        # entry id -> (bucket, question vector, answer, expiry time, size)
+        self.entries = OrderedDict()
+        # (context hash, parameters) -> ids of the entries of the bucket
+        self.buckets = {}
+        self.size = 0
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def depends_on_history(question, has_history):
+        """
+        Check if the question probably refers to earlier turns, such questions bypass
+        the cache since the same words can need a different answer in another conversation
+        """
+        return has_history and HISTORY_REFERENCE.search(question) is not None
+
+    @staticmethod
+    def get_bucket(context, parameters):
+        """
+        Get the bucket of a retrieved context and a set of model parameters
+        """
+        context_hash = hashlib.sha256((context or "").encode("utf8")).hexdigest()
+        return context_hash, tuple(parameters)
+
+    def _remove(self, entry_id):
+        """
+        Remove an entry, must be called with the lock held
+        """
+        bucket, _, _, _, size = self.entries.pop(entry_id)
+        self.size -= size
+        ids = self.buckets[bucket]
+        ids.discard(entry_id)
+        if not ids:
+            del self.buckets[bucket]
+
+    def lookup(self, question_vector, context, parameters):
+        """
+        Get the cached answer of the closest question, None when nothing is close enough
+        """
+        if not self.enabled:
+            return None
+
+        bucket = self.get_bucket(context, parameters)
+        query = _normalize(question_vector)
+        now = time.monotonic()
+
+        with self.lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self.buckets.get(bucket, ())):
+                _, vector, _, expires, _ = self.entries[entry_id]
+                if expires < now:
+                    self._remove(entry_id)
+                    continue
+                score = sum(a * b for a, b in zip(query, vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                metrics.RESPONSE_CACHE.inc(result="miss")
+                return None
+
+            self.entries.move_to_end(best_id)
+            metrics.RESPONSE_CACHE.inc(result="hit")
+            return self.entries[best_id][2]
+
+    def store(self, question_vector, context, parameters, answer):
+        """
+        Cache the answer of a question
+        """
+        if not self.enabled:
+            return
+
+        bucket = self.get_bucket(context, parameters)
+        size = len(answer.encode("utf8")) + 8 * len(question_vector)
+
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (bucket, _normalize(question_vector), answer,
+                                      time.monotonic() + self.ttl, size)
+            self.buckets.setdefault(bucket, set()).add(entry_id)
+            self.size += size
+
+            while self.entries and (len(self.entries) > self.max_entries or
+                                    self.size > self.max_bytes):
+                self._remove(next(iter(self.entries)))
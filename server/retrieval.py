@@ -0,0 +1,128 @@
+"""
+This module selects the facts that are injected in the prompt from the matches of an index
+query. Weak matches are cut relative to the best one (adaptive top-k) and exact duplicates
+are dropped. With RETRIEVAL_MMR=1 near duplicates are dropped too and the rest is reranked
+with maximal marginal relevance (MMR) against the question embedding so that the facts cover
+different aspects of the question. The selected facts are capped to a token budget
+"""
+import os
+import numpy as np
+from .embeddingcache import normalize_text
+from .budget import count_tokens
+from . import metrics
+
+
+class Retriever:
+    """
+    This class is the retrieval stage shared by the index clients
+    """
+    # number of matches requested from the index
+    top_k = int(os.environ.get("RETRIEVAL_TOP_K", "10"))
+    min_score = float(os.environ.get("RETRIEVAL_MIN_SCORE", "0.7"))
+    # matches scoring further than this below the best match are dropped
+    score_margin = float(os.environ.get("RETRIEVAL_SCORE_MARGIN", "0.15"))
+    max_facts = int(os.environ.get("RETRIEVAL_MAX_FACTS", "5"))
+    # facts at least this similar to an already selected fact are duplicates
+    duplicate_similarity = float(os.environ.get("RETRIEVAL_DUPLICATE_SIMILARITY", "0.95"))
+    # MMR needs the vectors of the matches, Pinecone only returns them when it is enabled
+    mmr = os.environ.get("RETRIEVAL_MMR", "0") == "1"
+    # 1 ranks by relevance only, lower values favour facts unlike the ones already selected
+    mmr_lambda = float(os.environ.get("RETRIEVAL_MMR_LAMBDA", "0.7"))
+    # hard cap on the tokens of the injected facts
+    max_tokens = int(os.environ.get("RETRIEVAL_MAX_TOKENS", "1000"))
+
+    def __init__(self, top_k=None, max_facts=None, max_tokens=None):
+        if top_k is not None:
+            self.top_k = top_k
+        if max_facts is not None:
+            self.max_facts = max_facts
+        if max_tokens is not None:
+            self.max_tokens = max_tokens
+
+    @staticmethod
+    def _normalize(vectors):
+        """
+        Scale the rows of a matrix to unit length
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    def _candidates(self, matches):
+        """
+        Keep the matches that pass the score threshold and are close to the best match,
+        and drop the exact duplicates of a fact
+        """
+        matches = sorted((match for match in matches if match['score'] > self.min_score),
+                         key=lambda match: match['score'], reverse=True)
+        if not matches:
+            return []
+
+        best = matches[0]['score']
+        candidates = []
+        seen = set()
+        for match in matches:
+            key = normalize_text(match['metadata']['fact']).lower()
+            if match['score'] >= best - self.score_margin and key not in seen:
+                seen.add(key)
+                candidates.append(match)
+        return candidates
+
+    def _rerank(self, query_vector, candidates):
+        """
+        Order the candidates by maximal marginal relevance and drop the near duplicates
+        Candidates keep the order of their scores when MMR is disabled or they have no vectors
+        """
+        if not self.mmr:
+            return candidates
+        vectors = [match.get('values') for match in candidates]
+        if query_vector is None or any(vector is None or len(vector) == 0 for vector in vectors):
+            return candidates
+
+        vectors = self._normalize(vectors)
+        relevance = vectors @ self._normalize(query_vector)
+        similarity = vectors @ vectors.T
+
+        selected = []
+        remaining = list(range(len(candidates)))
+        while remaining and len(selected) < self.max_facts:
+            if selected:
+                redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+            else:
+                redundancy = np.zeros(len(remaining), dtype=np.float32)
+            keep = redundancy < self.duplicate_similarity
+            remaining = [row for row, kept in zip(remaining, keep) if kept]
+            redundancy = redundancy[keep]
+            if not remaining:
+                break
+
+            scores = self.mmr_lambda * relevance[remaining] - (1 - self.mmr_lambda) * redundancy
+            selected.append(remaining.pop(int(np.argmax(scores))))
+
+        return [candidates[row] for row in selected]
+
+    def select(self, query_vector, matches):
+        """
+        Select the facts to inject in the prompt from the matches of a query
+        Returns a list of {'id', 'score', 'fact'} dicts in the order of the prompt
+        """
+        with metrics.timed("retrieval"):
+            ranked = self._rerank(query_vector, self._candidates(matches))
+
+            selected = []
+            tokens = 0
+            for match in ranked[:self.max_facts]:
+                fact = match['metadata']['fact']
+                fact_tokens = count_tokens(fact)
+                if tokens + fact_tokens > self.max_tokens:
+                    continue
+                tokens += fact_tokens
+                selected.append({'id': match['id'], 'score': match['score'], 'fact': fact})
+
+        return selected
+
+    @staticmethod
+    def format(selected):
+        """
+        Join the selected facts into the context of the prompt
+        """
+        return "".join(match['fact'] + "\n" for match in selected)
@@ -0,0 +1,137 @@
+"""
+This module contains the model router
+Each call type (answer, summarize, tool follow-up) has a route: a list of models in order of
+preference, the first one is used and the others are fallbacks. Prompts that are too large
+for a model skip it, short prompts can be sent to a cheaper route, and models with a high
+recent error rate or latency are tried after the healthy ones
+"""
+import os
+import time
+import threading
+from collections import deque
+
+# Context window of the known models, in tokens
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0301": 4096,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo-16k-0613": 16385,
+    "gpt-4": 8192,
+    "gpt-4-0613": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106-preview": 128000,
+}
+
+
+def parse_route(value):
+    """
+    Parse a comma separated list of models
+    """
+    return [model.strip() for model in value.split(",") if model.strip()]
+
+
+class ModelRouter:
+    """
+    This class picks the models of a call and tracks the health of every model
+    Routes are set with MODEL_ROUTE_<CALL TYPE>, e.g. MODEL_ROUTE_SUMMARIZE=gpt-3.5-turbo,
+    the answer route defaults to the default model and the other routes to the answer route.
+    Prompts under SMALL_PROMPT_TOKENS tokens use MODEL_ROUTE_SMALL when it is set
+    """
+    small_prompt_tokens = int(os.environ.get("SMALL_PROMPT_TOKENS", "0"))
+    # tokens kept free in the context window for the completion
+    completion_reserve = int(os.environ.get("MODEL_COMPLETION_RESERVE", "512"))
+    # a model is degraded when its recent calls fail or are slow
+    health_window = float(os.environ.get("MODEL_HEALTH_WINDOW", "300"))
+    max_error_rate = float(os.environ.get("MODEL_MAX_ERROR_RATE", "0.25"))
+    # p95 latency in seconds above which a model is degraded, 0 disables the check
+    max_latency = float(os.environ.get("MODEL_MAX_LATENCY", "0"))
+    min_samples = 5
+    max_samples = 500
+
+    def __init__(self, default_model, routes=None):
+        answer = parse_route(os.environ.get("MODEL_ROUTE_ANSWER", default_model))
+        self.routes = {
+            "answer": answer,
+            "summarize": parse_route(os.environ.get("MODEL_ROUTE_SUMMARIZE", "")) or answer,
+            "tool": parse_route(os.environ.get("MODEL_ROUTE_TOOL", "")) or answer,
+            "small": parse_route(os.environ.get("MODEL_ROUTE_SMALL", "")),
+        }
+        if routes is not None:
+            self.routes.update(routes)
+        # model -> recent (time, seconds, failed) samples
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def _get_samples(self, model, now):
+        """
+        Get the samples of a model inside the health window, must be called with the lock held
+        """
+        samples = self.samples.get(model)
+        if samples is None:
+            return []
+        while samples and samples[0][0] < now - self.health_window:
+            samples.popleft()
+        return list(samples)
+
+    def record(self, model, seconds, failed=False):
+        """
+        Record the outcome of a call to a model
+        """
+        with self.lock:
+            samples = self.samples.get(model)
+            if samples is None:
+                samples = self.samples[model] = deque(maxlen=self.max_samples)
+            samples.append((time.monotonic(), seconds, failed))
+
+    def get_health(self, model):
+        """
+        Get the number of recent calls, the error rate and the p95 latency of a model
+        """
+        with self.lock:
+            samples = self._get_samples(model, time.monotonic())
+        if not samples:
+            return {"calls": 0, "error_rate": 0.0, "p95_seconds": 0.0}
+        latencies = sorted(seconds for _, seconds, failed in samples if not failed)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+        errors = sum(1 for _, _, failed in samples if failed)
+        return {"calls": len(samples), "error_rate": errors / len(samples), "p95_seconds": p95}
+
+    def is_healthy(self, model):
+        """
+        Check if the recent calls of a model succeed and are fast enough
+        A degraded model gets traffic again once its bad samples leave the health window
+        """
+        health = self.get_health(model)
+        if health["calls"] < self.min_samples:
+            return True
+        if health["error_rate"] > self.max_error_rate:
+            return False
+        return not self.max_latency or health["p95_seconds"] <= self.max_latency
+
+    def fits(self, model, prompt_tokens):
+        """
+        Check if a prompt and the completion fit in the context window of a model
+        Unknown models are assumed to fit
+        """
+        window = CONTEXT_WINDOWS.get(model)
+        return window is None or prompt_tokens + self.completion_reserve <= window
+
+    def get_models(self, call_type, prompt_tokens=0):
+        """
+        Get the models to try for a call, in order
+        The route of the call type is used, or the small route for short prompts. Models
+        the prompt does not fit are skipped, unless none fits, and healthy models come first
+        """
+        route = self.routes.get(call_type) or self.routes["answer"]
+        if self.routes.get("small") and prompt_tokens and \
+                prompt_tokens < self.small_prompt_tokens:
+            route = self.routes["small"] + route
+
+        models = list(dict.fromkeys(route))
+        fitting = [model for model in models if self.fits(model, prompt_tokens)]
+        models = fitting or models
+
+        healthy = [model for model in models if self.is_healthy(model)]
+        return healthy + [model for model in models if model not in healthy]
@@ -0,0 +1,303 @@
+"""
+This module contains the request scheduler that every OpenAI call goes through
+Calls are paced by token buckets on the requests and the tokens per minute of each model,
+transient errors are retried with jittered exponential backoff that honours Retry-After,
+and slow calls can be hedged: a duplicate request is sent once the call has taken longer
+than the recent p95 latency and the first answer wins
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from openai import error
+from .budget import count_tokens
+from . import metrics
+
+# tokens added by the chat format for each message
+TOKENS_PER_MESSAGE = 4
+
+
+def estimate_tokens(messages):
+    """
+    Estimate the prompt tokens of a list of chat messages, or of a list of texts
+    """
+    total = 0
+    for message in messages:
+        if isinstance(message, dict):
+            total += count_tokens(message.get("content") or "") + TOKENS_PER_MESSAGE
+        else:
+            total += count_tokens(message)
+    return total
+
+
+def is_retryable(err):
+    """
+    Check if an OpenAI error is transient and the call may be retried
+    """
+    if isinstance(err, (error.RateLimitError, error.Timeout, error.APIConnectionError,
+                        error.ServiceUnavailableError, error.TryAgain)):
+        return True
+    if isinstance(err, error.APIError):
+        return err.http_status is None or err.http_status == 429 or err.http_status >= 500
+    return False
+
+
+def get_retry_after(err):
+    """
+    Get the number of seconds the server asked us to wait, None when it did not say
+    """
+    headers = getattr(err, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    This class is a token bucket that refills per_minute tokens every minute
+    Callers reserve tokens and wait for the returned delay, the bucket may go into debt
+    so that waiting callers are served in the order they arrived
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """
+        Add the tokens earned since the last update, must be called with the lock held
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """
+        Take amount tokens, returns the number of seconds to wait before using them
+        """
+        if self.capacity <= 0:
+            return 0.0
+        with self.lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_take(self, amount):
+        """
+        Take amount tokens only if they are available now
+        """
+        if self.capacity <= 0:
+            return True
+        with self.lock:
+            self._refill()
+            if self.tokens < min(amount, self.capacity):
+                return False
+            self.tokens -= min(amount, self.capacity)
+            return True
+
+
+class RequestScheduler:
+    """
+    This class paces, retries and hedges the calls to the OpenAI API
+    A limit of 0 disables the corresponding bucket, hedging is off unless OPENAI_HEDGE=1
+    """
+    requests_per_minute = int(os.environ.get("OPENAI_RPM", "3500"))
+    tokens_per_minute = int(os.environ.get("OPENAI_TPM", "90000"))
+    max_retries = int(os.environ.get("OPENAI_MAX_RETRIES", "4"))
+    backoff_base = float(os.environ.get("OPENAI_BACKOFF_BASE", "0.5"))
+    backoff_max = float(os.environ.get("OPENAI_BACKOFF_MAX", "30"))
+    hedge = os.environ.get("OPENAI_HEDGE", "0") == "1"
+    # latencies kept per (kind, model) to compute the hedging delay
+    latency_window = 200
+    hedge_min_samples = 20
+    hedge_quantile = 0.95
+    # The blocking calls that are hedged run on these threads
+    executor = ThreadPoolExecutor(
+        max_workers=int(os.environ.get("OPENAI_HEDGE_THREADS", "32")),
+        thread_name_prefix="hedge")
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_retries=None,
+                 hedge=None):
+        if requests_per_minute is not None:
+            self.requests_per_minute = requests_per_minute
+        if tokens_per_minute is not None:
+            self.tokens_per_minute = tokens_per_minute
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if hedge is not None:
+            self.hedge = hedge
+        # model -> (requests bucket, tokens bucket)
+        self.buckets = {}
+        # (kind, model) -> recent latencies in seconds
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def _get_buckets(self, model):
+        """
+        Get the buckets of a model, the limits of the API are per model
+        """
+        with self.lock:
+            buckets = self.buckets.get(model)
+            if buckets is None:
+                buckets = self.buckets[model] = (TokenBucket(self.requests_per_minute),
+                                                 TokenBucket(self.tokens_per_minute))
+            return buckets
+
+    def _reserve(self, model, tokens):
+        """
+        Reserve one request and the tokens, returns the number of seconds to wait
+        """
+        requests_bucket, tokens_bucket = self._get_buckets(model)
+        delay = max(requests_bucket.reserve(1), tokens_bucket.reserve(tokens))
+        if delay > 0:
+            metrics.observe_stage("rate_limit_wait", delay, model)
+        return delay
+
+    def _try_reserve(self, model, tokens):
+        """
+        Reserve a hedged request only if the buckets have room for it right now
+        """
+        requests_bucket, tokens_bucket = self._get_buckets(model)
+        return requests_bucket.try_take(1) and tokens_bucket.try_take(tokens)
+
+    def _backoff(self, attempt, err):
+        """
+        Get the number of seconds to wait before retrying a failed call
+        """
+        retry_after = get_retry_after(err)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # full jitter, so that the callers that failed together do not retry together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _record_latency(self, kind, model, seconds):
+        """
+        Add the latency of a successful call to the window of its kind and model
+        """
+        with self.lock:
+            window = self.latencies.get((kind, model))
+            if window is None:
+                window = self.latencies[(kind, model)] = deque(maxlen=self.latency_window)
+            window.append(seconds)
+
+    def get_hedge_delay(self, kind, model):
+        """
+        Get the delay after which a call is hedged, None when hedging is off or there
+        are not enough samples yet
+        """
+        if not self.hedge:
+            return None
+        with self.lock:
+            window = sorted(self.latencies.get((kind, model), ()))
+        if len(window) < self.hedge_min_samples:
+            return None
+        return window[min(len(window) - 1, int(len(window) * self.hedge_quantile))]
+
+    def _should_retry(self, attempt, err, kind, model):
+        """
+        Check if a failed call is retried and count the retry
+        """
+        if attempt >= self.max_retries or not is_retryable(err):
+            return False
+        print(f"Retrying {kind} call to {model} after error:", err)
+        metrics.RETRIES.inc(stage=kind, model=model)
+        return True
+
+    def _call_hedged(self, request, kind, model, tokens):
+        """
+        Run a blocking call, sending a duplicate when it takes longer than the hedge delay
+        """
+        delay = self.get_hedge_delay(kind, model)
+        if delay is None:
+            return request()
+
+        futures = {self.executor.submit(request)}
+        done, _ = wait(futures, timeout=delay)
+        if not done and self._try_reserve(model, tokens):
+            metrics.HEDGES.inc(stage=kind, model=model)
+            futures.add(self.executor.submit(request))
+
+        # the first successful answer wins, the slower call is left to finish on its own
+        pending = futures
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    return future.result()
+
+    def call(self, request, model, kind="completion", tokens=0, hedge=False):
+        """
+        Run request() under the rate limits of the model, retrying transient errors
+        Set hedge for idempotent calls that may be duplicated when they are slow
+        """
+        attempt = 0
+        while True:
+            time.sleep(self._reserve(model, tokens))
+            start = time.perf_counter()
+            try:
+                if hedge:
+                    result = self._call_hedged(request, kind, model, tokens)
+                else:
+                    result = request()
+            except Exception as err: # pylint: disable=broad-except
+                if not self._should_retry(attempt, err, kind, model):
+                    raise
+                time.sleep(self._backoff(attempt, err))
+                attempt += 1
+                continue
+            self._record_latency(kind, model, time.perf_counter() - start)
+            return result
+
+    async def _acall_hedged(self, request, kind, model, tokens):
+        """
+        This is the asyncio version of _call_hedged, the slower call is cancelled
+        """
+        delay = self.get_hedge_delay(kind, model)
+        if delay is None:
+            return await request()
+
+        tasks = {asyncio.ensure_future(request())}
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done and self._try_reserve(model, tokens):
+            metrics.HEDGES.inc(stage=kind, model=model)
+            tasks.add(asyncio.ensure_future(request()))
+
+        pending = tasks
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None or not pending:
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def acall(self, request, model, kind="completion", tokens=0, hedge=False):
+        """
+        This is the asyncio version of call, request() must return an awaitable
+        """
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._reserve(model, tokens))
+            start = time.perf_counter()
+            try:
+                if hedge:
+                    result = await self._acall_hedged(request, kind, model, tokens)
+                else:
+                    result = await request()
+            except Exception as err: # pylint: disable=broad-except
+                if not self._should_retry(attempt, err, kind, model):
+                    raise
+                await asyncio.sleep(self._backoff(attempt, err))
+                attempt += 1
+                continue
+            self._record_latency(kind, model, time.perf_counter() - start)
+            return result
@@ -0,0 +1,118 @@
+"""
+This module contains a cache for web search results
+Results are keyed by the normalized query and the search parameters. Entries expire after
+a TTL, recently used entries are kept in an in-memory LRU and, when a path is set, every
+entry is also written to a SQLite file so the cache survives restarts
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from . import metrics
+
+# Parameters that do not change the results of a search
+IGNORED_PARAMETERS = ("q", "api_key", "output")
+
+
+def normalize_query(query):
+    """
+    Normalize a search query, so that case and whitespace variations share a key
+    """
+    return " ".join(query.lower().split())
+
+
+class SearchCache:
+    """
+    This class is a two tier (memory and disk) cache of search results with a TTL
+    The disk tier is disabled unless SEARCH_CACHE_PATH is set
+    """
+    path = os.environ.get("SEARCH_CACHE_PATH", "")
+    ttl = float(os.environ.get("SEARCH_CACHE_TTL", "3600"))
+    max_memory_items = int(os.environ.get("SEARCH_CACHE_SIZE", "1000"))
+
+    def __init__(self, path=None, ttl=None, max_memory_items=None):
+        if path is not None:
+            self.path = path
+        if ttl is not None:
+            self.ttl = ttl
+        if max_memory_items is not None:
+            self.max_memory_items = max_memory_items
+        # key -> (expiry time, response, sources)
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        if self.path:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS searches "
+                "(key TEXT PRIMARY KEY, expires REAL, response TEXT, sources TEXT)")
+            self.connection.commit()
+
+    @staticmethod
+    def get_key(query, params):
+        """
+        Get the cache key for a query and the search parameters
+        """
+        relevant = sorted((name, str(value)) for name, value in params.items()
+                          if name not in IGNORED_PARAMETERS and value is not None)
+        payload = json.dumps([normalize_query(query), relevant])
+        return hashlib.sha256(payload.encode("utf8")).hexdigest()
+
+    def _remember(self, key, entry):
+        """
+        Add an entry to the memory tier, must be called with the lock held
+        """
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, query, params):
+        """
+        Get the cached (response, sources) of a search, None when it is not cached
+        or has expired
+        """
+        key = self.get_key(query, params)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] >= now:
+                    self.memory.move_to_end(key)
+                    metrics.SEARCH_CACHE.inc(result="memory_hit")
+                    return entry[1], entry[2]
+                del self.memory[key]
+
+            if self.connection is not None:
+                row = self.connection.execute(
+                    "SELECT expires, response, sources FROM searches WHERE key = ?",
+                    (key,)).fetchone()
+                if row is not None and row[0] >= now:
+                    entry = (row[0], json.loads(row[1]), json.loads(row[2]))
+                    self._remember(key, entry)
+                    metrics.SEARCH_CACHE.inc(result="disk_hit")
+                    return entry[1], entry[2]
+
+            metrics.SEARCH_CACHE.inc(result="miss")
+            return None
+
+    def put(self, query, params, response, sources):
+        """
+        Store the result of a search in both tiers, the response is text or, for sports
+        results, a dict, so it is written to disk as JSON like the sources
+        """
+        key = self.get_key(query, params)
+        entry = (time.time() + self.ttl, response, list(sources))
+        with self.lock:
+            self._remember(key, entry)
+            if self.connection is not None:
+                self.connection.execute(
+                    "DELETE FROM searches WHERE expires < ?", (time.time(),))
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO searches (key, expires, response, sources) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, entry[0], json.dumps(response), json.dumps(entry[2])))
+                self.connection.commit()
@@ -6,95 +6,58 @@ It can be used to:
 2. Create an OpenAI training file from the facts in the Azure blob storage
 3. Enable an interactive chat session with the Open AI public or fine tuned model
 """
+import os
+import time
+import uuid
 import datetime
+import threading
 import json
 import argparse
-import ast
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters.html import HtmlFormatter
 from .azurecli import AzureCli
+from .exporter import TrainingFileExporter, get_newer_than_error
+from .factsync import FactSync, read_facts
 from .openaicli import OpenAICli
-from .conversation import Conversation
-from .pineconecli import PineconeCli
+from .sessions import SessionStore
+from .postprocess import postprocess
+from .indexcli import get_index_cli
+from . import metrics
 
 oai = OpenAICli()
-con = Conversation()
+sessions = SessionStore()
 azc = AzureCli()
-pc = PineconeCli()
+pc = get_index_cli()
 VERBOSE = False
+FACTS_FILE = "output.jsonl"
 
+# Facts of a batch are written to Azure on these threads
+FACT_WRITE_THREADS = int(os.environ.get("FACT_WRITE_THREADS", "16"))
+fact_writer = ThreadPoolExecutor(max_workers=FACT_WRITE_THREADS, thread_name_prefix="write-fact")
 
-def is_python_code(text):
-    """
-    Check if the text is valid Python code
-    """
-    try:
-        ast.parse(text)
-        return True
-    except SyntaxError:
-        return False
-
-
-def format_code(code):
-    """
-    Format the code using Pygments
-    """
-    lexer = get_lexer_by_name("python")
-    highlighted_code = highlight(code, lexer, HtmlFormatter())
-
-    # Get the CSS rules for the highlighted code
-    css = HtmlFormatter().get_style_defs(".highlight")
-
-    # Generate the HTML document
-    html = f"<html><head><style>\n{css}\n</style></head>\n<body>\n\
-            {highlighted_code}\n</body></html>"
-
-    return html
+# Blob names embed a microsecond timestamp that is unique within this process, and a
+# random process id that keeps the names of different server processes apart
+PROCESS_ID = uuid.uuid4().hex[:8]
+blob_name_lock = threading.Lock()
+last_blob_time = 0
 
 
 def loadfacts():
     """
-    Load the facts from the JSONL file
-    """
-    # Open the JSONL file in read mode
-    with open("output.jsonl", 'r', encoding='utf8') as fact_f:
-        # Initialize an empty list to store the parsed JSON objects
-        json_list = []
-
-        # Iterate through each line in the file
-        for line in fact_f:
-            # Parse the JSON object from the line
-            json_obj = json.loads(line)
-            # Add the parsed JSON object to the list
-            json_list.append(json_obj)
-
-        return json_list
-
-
-# Define a function to generate embeddings for a list of texts using OpenAI's GPT-3 model
-def generate_embedding_vectors(facts):
-    """
-    Generate embedding vectors for a list of facts
+    Load the facts from the JSONL file, the facts are read one at a time
     """
-    vectors = []
-    for index, fact in enumerate(facts):
-        fact_text = fact['fact']
-        embedding = oai.get_embedding(fact_text)
-        vector = (f"{index}", embedding, fact)
-        vectors.append(vector)
-    return vectors
+    for _, fact in read_facts(FACTS_FILE):
+        yield fact
 
 
 def facts_to_embeddings():
     """
-    Generate embedding vectors for the facts in the JSONL file
+    Sync the embedding vectors of the facts in the JSONL file to the vector index
+    The file is streamed through the sync pipeline and an interrupted sync resumes where
+    it stopped. Only new or changed facts are embedded, removed facts are deleted
     """
-    facts = loadfacts()
-    embedding_vectors = generate_embedding_vectors(facts)
-    pc.upsert_vectors(embedding_vectors)
+    return FactSync(oai, pc).sync(FACTS_FILE)
 
 
 def default_filename():
@@ -108,35 +71,31 @@ def default_filename():
 def default_blob_name():
     """
     Create a default filename for the blob
+    Names are unique and sort in the order they were created, even when many facts
+    are written in the same second
     """
-    now = datetime.datetime.now()
-    return f'blob.{now.strftime("%Y%m%d%H%M%S")}.json'
+    global last_blob_time # pylint: disable=global-statement
+    with blob_name_lock:
+        blob_time = max(time.time_ns() // 1000, last_blob_time + 1)
+        last_blob_time = blob_time
 
+    seconds, microseconds = divmod(blob_time, 1000000)
+    now = datetime.datetime.fromtimestamp(seconds)
+    return f'blob.{now.strftime("%Y%m%d%H%M%S")}.{microseconds:06d}.{PROCESS_ID}.json'
 
-def create_training_file():
+
+def create_training_file(newer_than=None):
     """
     Create a training file from the JSON objects in the Azure blob storage
+    Only the facts modified on or after newer_than are exported
     """
-    # Iterate through the blobs and print their contents to a file
     filename = default_filename()
 
-    with open(filename, "w", encoding='utf8') as output_file:
-        blobs = azc.get_blob_list()
-
-        # Iterate through the blobs
-        for blob in blobs:
-
-            # Retrieve the JSON object from the blob
-            fact = azc.get_json_from_blob(blob.name)
-
-            facttext = {'prompt': fact['prompt'],
-                        'completion': ' '+fact['completion']}
-
-            # Print the JSON object to the file
-            output_file.write(json.dumps(facttext))
-            output_file.write("\n")
+    # The blobs are downloaded in parallel and written to the file in listing order
+    count = TrainingFileExporter(azc).export(filename, newer_than)
 
     # The output file should now contain the contents of all blobs, one per line
+    return filename, count
 
 
 def delete_all_blobs():
@@ -157,16 +116,55 @@ def get_image(text):
     return response
 
 
-def get_response(text):
+def get_response(text, session_id=None):
     """
-    Get a response from the Open AI API
+    Get a response from the Open AI API, returns the ResponseType and the text
     """
-    response = con.get_response(text, VERBOSE).strip()
+    response = sessions.get(session_id).get_response(text, VERBOSE).strip()
 
-    if is_python_code(response):
-        response = format_code(response)
+    return postprocess(response)
 
-    return response
+
+def format_event(event, payload):
+    """
+    Format a server-sent event
+    """
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+def stream_response(text, session_id=None):
+    """
+    Stream a response from the Open AI API as server-sent events
+    """
+    start = time.perf_counter()
+    status = "error"
+    try:
+        conversation = sessions.get(session_id)
+        for event, data in conversation.get_response_stream(text, VERBOSE):
+            if event == "done":
+                rtype, response = postprocess(data.strip())
+                yield format_event(event, {'type': rtype.name, 'text': response})
+            else:
+                yield format_event(event, {'text': data})
+        status = "ok"
+    except GeneratorExit:
+        # the client disconnected before the answer was complete
+        status = "disconnected"
+        raise
+    finally:
+        metrics.record_request("stream-response", time.perf_counter() - start, status)
+
+
+def get_text_error(command, text):
+    """
+    This function returns why the text sent with a command is invalid, None when it is valid
+    """
+    if command == "create-training-file":
+        # text is the --newer-than date
+        return get_newer_than_error(text)
+    if command == "write-facts" and not isinstance(text, list):
+        return "The text of write-facts must be a list of facts"
+    return None
 
 
 def write_fact(jsonfact):
@@ -176,6 +174,33 @@ def write_fact(jsonfact):
     azc.store_json_in_blob(jsonfact, default_blob_name())
 
 
+def write_facts(facts):
+    """
+    Write a batch of facts to the Azure blob storage in parallel
+    Returns the status of every fact, in input order
+    """
+    def write(index, jsonfact, blob_name):
+        try:
+            azc.store_json_in_blob(jsonfact, blob_name)
+            return {'index': index, 'status': 'ok', 'blob': blob_name}
+        except Exception as err: # pylint: disable=broad-except
+            return {'index': index, 'status': 'error', 'error': str(err)}
+
+    # the names are allocated in input order so the blobs sort like the batch
+    futures = [fact_writer.submit(write, index, jsonfact, default_blob_name())
+               for index, jsonfact in enumerate(facts)]
+    return [future.result() for future in futures]
+
+
+def write_facts_output(results):
+    """
+    Format the result of a write-facts batch
+    """
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    return {'type': 'Text', 'text': f"Wrote {len(results) - failed} facts, {failed} failed.",
+            'results': results}
+
+
 app = Flask(__name__)
 
 app.config['JSON_AS_ASCII'] = False
@@ -184,6 +209,32 @@ app.config['JSON_SORT_KEYS'] = False
 CORS(app)
 
 
+@app.before_request
+def start_request_timer():
+    """
+    Remember when the request started
+    """
+    g.start_time = time.perf_counter()
+
+
+@app.teardown_request
+def record_request_metrics(exc):
+    """
+    Record the duration of the request, labeled by command
+    """
+    if 'command' in g:
+        metrics.record_request(g.command, time.perf_counter() - g.start_time,
+                               "error" if exc is not None else "ok")
+
+
+@app.route('/metrics', methods=['GET'])
+def handle_metrics():
+    """
+    Expose the latency and token metrics in the Prometheus text format
+    """
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
 @app.route('/', methods=['POST'])
 def handle_data():
     """
@@ -196,19 +247,37 @@ def handle_data():
 
     text = data['text']
     command = data['command']
+    # each client keeps its own conversation history
+    session_id = data.get('session_id')
+    error = sessions.get_id_error(session_id) or get_text_error(command, text)
+    if error is not None:
+        return jsonify({'type': 'Text', 'text': error}), 400
 
     output = {}
+    if command == "stream-response":
+        # Send the tokens to the client as they arrive, the request is timed by the stream
+        return Response(stream_with_context(stream_response(text, session_id)),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    g.command = command
     if command == "get-response":
         # Return the text as-is
-        rtype, response = get_response(text)
+        rtype, response = get_response(text, session_id)
         output = {'type': rtype.name, 'text': response}
     elif command == "clear-history":
-        # clear public and private conversation history
-        con.reset()
+        # clear the conversation history of this session only
+        sessions.reset(session_id)
         output = {'type': 'Text', 'text': "History cleared."}
+    elif command == "create-training-file":
+        # text is the --newer-than date
+        filename, count = create_training_file(text)
+        output = {'type': 'Text', 'text': f"Wrote {count} facts to {filename}."}
     elif command == "write-fact":
         # write the fact to the fact file
         write_fact(text)
+    elif command == "write-facts":
+        # text is a list of facts
+        output = write_facts_output(write_facts(text))
     elif command == "kill-all-facts":
         # delete all the facts
         # delete_all_blobs()
@@ -223,13 +292,62 @@ def handle_data():
     return returnoutput
 
 
+@app.route('/facts', methods=['POST'])
+def handle_facts():
+    """
+    Write the facts of a JSONL (one fact per line) request body
+    The body is read as a stream and written in batches, so it can be arbitrarily large.
+    A malformed line gets an error status and the following lines are still written
+    """
+    g.command = "write-facts"
+    batch_size = 4 * FACT_WRITE_THREADS
+    results = []
+    batch = []
+    # position in the body of each fact of the batch
+    positions = []
+
+    def flush():
+        for fact_position, result in zip(positions, write_facts(batch)):
+            result['index'] = fact_position
+            results.append(result)
+        batch.clear()
+        positions.clear()
+
+    position = 0
+    for line in request.stream:
+        if not line.strip():
+            continue
+        try:
+            batch.append(json.loads(line))
+            positions.append(position)
+        except ValueError as err:
+            # JSONDecodeError and UnicodeDecodeError, only this fact fails
+            results.append({'index': position, 'status': 'error', 'error': str(err)})
+        position += 1
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    results.sort(key=lambda result: result['index'])
+    return jsonify(write_facts_output(results))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Verbose logging')
+    parser.add_argument('-s', '--sync-embeddings', action='store_true',
+                        help='Sync the facts in output.jsonl to the vector index and exit, '
+                        'an interrupted sync resumes where it stopped')
 
     args = parser.parse_args()
 
+    if args.sync_embeddings:
+        stats = facts_to_embeddings()
+        print(f"Added {stats['added']}, removed {stats['removed']}, "
+              f"unchanged {stats['unchanged']} facts.")
+        raise SystemExit(0)
+
     if args.verbose:
         VERBOSE = True
         print("Verbose logging enabled.")
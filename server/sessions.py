@@ -0,0 +1,94 @@
+"""
+This module contains the session store that keeps one conversation per client session
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from .conversation import Conversation
+
+
+class SessionStore:
+    """
+    This class maps client supplied session ids to their own Conversation
+    The store is bounded: sessions that have been idle for longer than idle_timeout
+    seconds are evicted, and when the store is full the least recently used session
+    is evicted to make room for a new one
+    """
+    max_sessions = int(os.environ.get("CHAT_MAX_SESSIONS", "1000"))
+    idle_timeout = float(os.environ.get("CHAT_SESSION_IDLE_TIMEOUT", "3600"))
+    default_session_id = "default"
+    max_session_id_length = 128
+
+    def __init__(self, max_sessions=None, idle_timeout=None, conversation_factory=Conversation):
+        if max_sessions is not None:
+            self.max_sessions = max_sessions
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        self.conversation_factory = conversation_factory
+        # session id -> [conversation, last used time], ordered from least to most recently used
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_id_error(self, session_id):
+        """
+        This function returns why a client supplied session id is invalid, None when it is valid
+        """
+        if session_id is not None and len(str(session_id)) > self.max_session_id_length:
+            return f"Session id is longer than {self.max_session_id_length} characters"
+        return None
+
+    def _normalize_id(self, session_id):
+        """
+        This function validates the client supplied session id
+        """
+        if session_id is None or session_id == "":
+            return self.default_session_id
+        error = self.get_id_error(session_id)
+        if error is not None:
+            raise ValueError(error)
+        return str(session_id)
+
+    def _evict_idle(self, now):
+        """
+        This function evicts the sessions that have been idle for too long
+        Must be called with the lock held
+        """
+        while self.sessions:
+            session_id, (_, last_used) = next(iter(self.sessions.items()))
+            if now - last_used <= self.idle_timeout:
+                break
+            del self.sessions[session_id]
+
+    def get(self, session_id):
+        """
+        This function returns the conversation for the session, creating it if needed
+        """
+        session_id = self._normalize_id(session_id)
+        now = time.monotonic()
+
+        with self.lock:
+            self._evict_idle(now)
+
+            entry = self.sessions.pop(session_id, None)
+            if entry is None:
+                while len(self.sessions) >= self.max_sessions:
+                    # Evict the least recently used session
+                    self.sessions.popitem(last=False)
+                entry = [self.conversation_factory(), now]
+
+            entry[1] = now
+            self.sessions[session_id] = entry
+            return entry[0]
+
+    def reset(self, session_id):
+        """
+        This function forgets the conversation of a single session
+        """
+        session_id = self._normalize_id(session_id)
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
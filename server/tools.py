@@ -2,18 +2,41 @@
 This module containts tools that assist the chatbot
 """
 import os
+import json
+import time
+import asyncio
 import getpass
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import aiohttp
 from serpapi import GoogleSearch
+from .searchcache import SearchCache
+from . import metrics
+
+SERPAPI_URL = "https://serpapi.com/search.json"
 
 class Tools:
     """
     This class contains tools that assist the chatbot
+    Each tool is registered in tools with a JSON schema of its arguments (for the function
+    calling API) and a timeout, and in tool_apis with the function that runs it
     """
+    # The tool calls of one turn run concurrently on these threads. A call that times out
+    # keeps its thread until it returns, so the calls in flight are capped at the number of
+    # threads and the calls over the cap fail at once instead of queueing behind them
+    tool_threads = int(os.environ.get("TOOL_THREADS", "16"))
+    executor = ThreadPoolExecutor(max_workers=tool_threads, thread_name_prefix="tool")
+    slots = threading.BoundedSemaphore(tool_threads)
+    # seconds to wait for a tool that has no timeout of its own
+    default_timeout = float(os.environ.get("TOOL_TIMEOUT", "10"))
+    # shared by every Tools instance so that all sessions reuse the same search results
+    search_cache = SearchCache()
 
     def __init__(self):
         self.username = getpass.getuser()
 
+        # defaults of every search, each call copies them, see _search_params
         self.serpapi_params = {
             "engine": "google",
             "google_domain": "google.com",
@@ -24,32 +47,189 @@ class Tools:
         }
 
         self.tools = {
-            "search": {"description": "Search the web for information needed \
-                       to answer the question.", "parameter": "search term"},
+            "search": {
+                "description": "Search the web for information needed to answer the question.",
+                "parameter": "search term",
+                "parameters": {
+                    "type": "object",
+                    "properties": {"query": {"type": "string", "description": "The search term"}},
+                    "required": ["query"],
+                },
+                "argument": "query",
+                "timeout": float(os.environ.get("TOOL_SEARCH_TIMEOUT", "10")),
+            },
+            "get_username": {
+                "description": "Get the name of the current user.",
+                "parameter": None,
+                "parameters": {"type": "object", "properties": {}},
+                "timeout": 1.0,
+            },
+            "get_datetime": {
+                "description": "Get the current local date and time.",
+                "parameter": None,
+                "parameters": {"type": "object", "properties": {}},
+                "timeout": 1.0,
+            },
         }
 
         self.tool_apis = {
             "search": self.query_serpapi,
+            "get_username": self.get_username,
+            "get_datetime": self.get_datetime,
+        }
+
+        self.async_tool_apis = {
+            "search": self.aquery_serpapi,
         }
 
+        # created on first use, it is bound to the running event loop
+        self.http_session = None
+
     def call_tool(self, tool, parameter):
         """
         This function calls the tool with the given parameter
         """
         return self.tool_apis[tool](parameter)
 
+    async def acall_tool(self, tool, parameter):
+        """
+        This is the asyncio version of call_tool
+        Tools without an asyncio version do no I/O and are called directly
+        """
+        if tool not in self.async_tool_apis:
+            return self.call_tool(tool, parameter)
+        return await self.async_tool_apis[tool](parameter)
+
+    def get_timeout(self, tool):
+        """
+        This function returns the number of seconds to wait for a tool
+        """
+        return self.tools[tool].get("timeout", self.default_timeout)
+
+    def _timed_call(self, tool, parameter):
+        """
+        Call a tool on a tool thread and record its latency, the slot taken by _submit
+        is released when the call returns
+        """
+        try:
+            with metrics.timed("tool", tool):
+                return self.call_tool(tool, parameter)
+        finally:
+            self.slots.release()
+
+    def _submit(self, tool, parameter):
+        """
+        Run a call on a tool thread, None when every thread is busy with earlier calls
+        """
+        if not self.slots.acquire(blocking=False):
+            return None
+        return self.executor.submit(self._timed_call, tool, parameter)
+
+    def call_tools(self, calls):
+        """
+        This function runs a list of (tool, parameter) calls concurrently
+        It returns an (output, sources) tuple per call, in the order of the calls,
+        a call that fails or times out gets (None, None)
+        """
+        start = time.monotonic()
+        futures = [self._submit(tool, parameter) for tool, parameter in calls]
+
+        results = []
+        for (tool, parameter), future in zip(calls, futures):
+            if future is None:
+                print(f"Tool {tool}({parameter}) skipped, all the tool threads are busy")
+                results.append((None, None))
+                continue
+            remaining = start + self.get_timeout(tool) - time.monotonic()
+            try:
+                results.append(future.result(timeout=max(remaining, 0)))
+            except FutureTimeoutError:
+                print(f"Tool {tool}({parameter}) timed out")
+                if future.cancel():
+                    # it never started, so _timed_call will not release its slot
+                    self.slots.release()
+                results.append((None, None))
+            except Exception as err: # pylint: disable=broad-except
+                print(f"Tool {tool}({parameter}) failed:", err)
+                results.append((None, None))
+
+        return results
+
+    async def _acall_with_timeout(self, tool, parameter):
+        """
+        Call a tool with its timeout and record its latency
+        """
+        try:
+            with metrics.timed("tool", tool):
+                return await asyncio.wait_for(
+                    self.acall_tool(tool, parameter), self.get_timeout(tool))
+        except asyncio.TimeoutError:
+            print(f"Tool {tool}({parameter}) timed out")
+        except Exception as err: # pylint: disable=broad-except
+            print(f"Tool {tool}({parameter}) failed:", err)
+        return None, None
+
+    async def acall_tools(self, calls):
+        """
+        This is the asyncio version of call_tools
+        """
+        return await asyncio.gather(
+            *(self._acall_with_timeout(tool, parameter) for tool, parameter in calls))
+
     def get_tools(self):
         """
         This function returns the tools dictionary
         """
         return self.tools
 
+    def get_invocations(self):
+        """
+        This function returns the tools in the $tool(parameter) text format, one per line,
+        for the prompt of the models that do not use the function calling API
+        """
+        return "\n".join(f"${name}({tool['parameter'] or ''}): {tool['description']}"
+                         for name, tool in self.tools.items())
+
+    def get_functions(self):
+        """
+        This function returns the tools in the format of the function calling API
+        """
+        return [{"type": "function",
+                 "function": {"name": name, "description": tool["description"],
+                              "parameters": tool["parameters"]}}
+                for name, tool in self.tools.items()]
+
+    def parse_function_call(self, name, arguments):
+        """
+        This function converts a function call of the model into a (tool, parameter) call
+        arguments is the JSON string sent by the model. Returns None for unknown tools
+        or arguments that are not valid JSON
+        """
+        tool = self.tools.get(name)
+        if tool is None:
+            return None
+        try:
+            arguments = json.loads(arguments or "{}")
+        except ValueError:
+            return None
+        if not isinstance(arguments, dict):
+            return None
+        if "argument" not in tool:
+            return name, None
+        return name, str(arguments.get(tool["argument"], ""))
+
     def get_username(self, parameter=None): # pylint: disable=unused-argument
         """
         This function returns the username
         """
         return self.username, "Local host"
 
+    def get_datetime(self, parameter=None): # pylint: disable=unused-argument
+        """
+        This function returns the current date and time
+        """
+        return self.__get_date()+" "+self.__get_time(), "Local host"
+
     def __process_response(self, res: dict):
         """
         Process response from SerpAPI.
@@ -82,19 +262,62 @@ class Tools:
             toret = "No good search result found"
         return toret
 
+    def _search_params(self, question):
+        """
+        Build the parameters of one search, the shared defaults are never modified
+        """
+        params = {key: value for key, value in self.serpapi_params.items() if value is not None}
+        params["q"] = question
+        return params
+
     def query_serpapi(self, question):
         """
         Query SerpAPI for the given question.
+        Results are served from the search cache when the same query was searched recently
         """
-        self.serpapi_params["q"] = question
+        cached = self.search_cache.get(question, self.serpapi_params)
+        if cached is not None:
+            return cached
 
-        serpapi_client = GoogleSearch(self.serpapi_params)
+        serpapi_client = GoogleSearch(self._search_params(question))
         results = serpapi_client.get_dict()
         sources = [result["link"] for result in results["organic_results"]]
 
         response = self.__process_response(results)
+        self.search_cache.put(question, self.serpapi_params, response, sources)
         return response, sources
 
+    async def aquery_serpapi(self, question):
+        """
+        This is the asyncio version of query_serpapi
+        It calls the SerpAPI JSON endpoint directly so the event loop is never blocked
+        """
+        cached = self.search_cache.get(question, self.serpapi_params)
+        if cached is not None:
+            return cached
+
+        if self.http_session is None or self.http_session.closed:
+            self.http_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=30))
+
+        params = self._search_params(question)
+        params["output"] = "json"
+        async with self.http_session.get(SERPAPI_URL, params=params) as http_response:
+            results = await http_response.json()
+        sources = [result["link"] for result in results.get("organic_results", [])]
+
+        response = self.__process_response(results)
+        self.search_cache.put(question, self.serpapi_params, response, sources)
+        return response, sources
+
+    async def aclose(self):
+        """
+        This function closes the HTTP session used by the asyncio tools
+        """
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+
     def __get_time(self):
         """
         This function returns the current time
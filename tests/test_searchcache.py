@@ -0,0 +1,29 @@
+"""
+Tests of the search result cache
+"""
+from server.searchcache import SearchCache
+
+
+def test_disk_cache_round_trips_a_dict_response(tmp_path):
+    """
+    Sports results are dicts, they are stored on disk and read back by a new cache
+    """
+    path = str(tmp_path / "searches.sqlite")
+    params = {"engine": "google", "q": "seahawks score"}
+    response = {"league": "NFL", "teams": [{"name": "Seahawks", "score": "24"}]}
+    SearchCache(path=path).put("Seahawks score", params, response, ["https://example.com"])
+
+    cached = SearchCache(path=path).get("seahawks  score", params)
+
+    assert cached == (response, ["https://example.com"])
+
+
+def test_disk_cache_round_trips_a_text_response(tmp_path):
+    """
+    Text responses read back from disk are the same text
+    """
+    path = str(tmp_path / "searches.sqlite")
+    params = {"engine": "google"}
+    SearchCache(path=path).put("weather", params, "Sunny, 20C", [])
+
+    assert SearchCache(path=path).get("weather", params) == ("Sunny, 20C", [])
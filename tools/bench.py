@@ -0,0 +1,556 @@
+""" This is a load test and benchmark harness for the chatbot server.
+It starts the Flask server in-process with fake OpenAI, vector index, tools and Azure
+backends, so no paid API is called. The fakes implement the interfaces of OpenAICli,
+PineconeCli, Tools and AzureCli with configurable latency distributions, token rates
+and error rates.
+
+Scripted multi-turn conversations are replayed at the target concurrency (one session per
+conversation) and the tool prints a JSON report with the p50/p95/p99 latency, throughput
+and a per-stage breakdown of the time spent in the fake backends. The report is written to
+--output or to stdout, the server logs are sent to stderr so they do not mix with it.
+
+The fakes draw their latencies from random generators seeded with --seed and the call
+input, so the same script and options produce the same simulated workload on every run
+and the reports of two commits can be compared.
+
+Usage:
+    python -m tools.bench --concurrency 16 --conversations 64 --turns 5
+    python -m tools.bench --script conversations.json --output report.json
+
+A script is a JSON list of conversations, each a list of questions.
+"""
+import os
+import sys
+import json
+import contextlib
+import time
+import math
+import random
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+FAKE_FACTS = [
+    {"id": "fact-hours", "score": 0.9, "fact": "The office is open from 9am to 5pm."},
+    {"id": "fact-phone", "score": 0.85, "fact": "The support line is 555-0100."},
+]
+QUESTION_TEMPLATES = [
+    "What are your hours on {day}?",
+    "Who should I call about {topic}?",
+    "Can you explain {topic} in a few sentences?",
+    "What happened with {topic} yesterday?",
+    "Write a short summary of {topic}.",
+]
+TOPICS = ["billing", "the release", "onboarding", "the outage", "pricing", "security"]
+DAYS = ["Monday", "Tuesday", "Friday", "Sunday"]
+
+
+def percentile(values, fraction):
+    """
+    Get a percentile of a list of values (nearest rank)
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def summarize(values):
+    """
+    Summarize a list of latencies in seconds as milliseconds
+    """
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": round(1000 * sum(values) / len(values), 3),
+        "p50_ms": round(1000 * percentile(values, 0.50), 3),
+        "p95_ms": round(1000 * percentile(values, 0.95), 3),
+        "p99_ms": round(1000 * percentile(values, 0.99), 3),
+        "max_ms": round(1000 * max(values), 3),
+        "total_s": round(sum(values), 3),
+    }
+
+
+class StageRecorder:
+    """
+    This class records the time spent in each backend stage
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+
+    def record(self, stage, seconds, failed=False):
+        """
+        Record one call of a stage
+        """
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+            if failed:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def report(self):
+        """
+        Get the per stage breakdown
+        """
+        with self.lock:
+            return {stage: dict(summarize(timings), errors=self.errors.get(stage, 0))
+                    for stage, timings in sorted(self.timings.items())}
+
+
+class FakeBackend:
+    """
+    This class simulates the latency and the errors of one upstream API
+    Latencies follow a log-normal distribution with the given median and sigma
+    """
+
+    def __init__(self, stage, recorder, seed, median_ms, sigma=0.3, error_rate=0.0):
+        self.stage = stage
+        self.recorder = recorder
+        self.seed = seed
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    def rng(self, payload):
+        """
+        Get a random generator seeded by the call input, so results do not depend on
+        the order in which concurrent calls arrive
+        """
+        digest = hashlib.sha256(f"{self.seed}:{self.stage}:{payload}".encode("utf8")).digest()
+        return random.Random(digest)
+
+    def latency(self, rng):
+        """
+        Draw a latency in seconds
+        """
+        return self.median_ms / 1000.0 * math.exp(rng.gauss(0, self.sigma))
+
+    def call(self, payload, extra_seconds=0.0):
+        """
+        Simulate one call: sleep for the drawn latency and maybe fail
+        Returns the random generator of the call for further draws
+        """
+        rng = self.rng(payload)
+        seconds = self.latency(rng) + extra_seconds
+        failed = rng.random() < self.error_rate
+        time.sleep(seconds)
+        self.recorder.record(self.stage, seconds, failed)
+        if failed:
+            raise RuntimeError(f"Simulated {self.stage} error")
+        return rng
+
+    async def acall(self, payload, extra_seconds=0.0):
+        """
+        This is the asyncio version of call
+        """
+        import asyncio # pylint: disable=import-outside-toplevel
+        rng = self.rng(payload)
+        seconds = self.latency(rng) + extra_seconds
+        failed = rng.random() < self.error_rate
+        await asyncio.sleep(seconds)
+        self.recorder.record(self.stage, seconds, failed)
+        if failed:
+            raise RuntimeError(f"Simulated {self.stage} error")
+        return rng
+
+
+class FakeOpenAICli:
+    """
+    This class fakes OpenAICli. Completions take a time to first token and then
+    stream answer_tokens tokens at token_rate tokens per second. With probability
+    tool_rate the first answer of a turn is a $search() invocation
+    """
+    model = "fake-model"
+    function_calling = False
+    temperature = 0.3
+    top_p = 1
+    frequency_penalty = 0.0
+    presence_penalty = 0.0
+
+    def __init__(self, recorder, seed, options):
+        self.completion = FakeBackend("completion", recorder, seed, options.completion_ms,
+                                      options.sigma, options.error_rate)
+        self.embedding = FakeBackend("embedding", recorder, seed, options.embedding_ms,
+                                     options.sigma, options.error_rate)
+        self.token_rate = options.token_rate
+        self.answer_tokens = options.answer_tokens
+        self.tool_rate = options.tool_rate
+
+    def _answer(self, messages, rng):
+        """
+        Build the fake answer of a completion
+        """
+        question = messages[-1]["content"]
+        searched = any(message["role"] == "assistant" and "search result" in message["content"]
+                       for message in messages[-4:])
+        if not searched and rng.random() < self.tool_rate:
+            return ["$search(", question[:40], ")"]
+        return [f"token{i} " for i in range(self.answer_tokens)]
+
+    def get_response(self, messages, tools=None, tool_calls=None,
+                     call_type="answer", models=None): # pylint: disable=unused-argument
+        """
+        Fake of OpenAICli.get_response
+        """
+        if models is not None:
+            models.append(self.model)
+        rng = self.completion.rng(json.dumps(messages))
+        tokens = self._answer(messages, rng)
+        self.completion.call(json.dumps(messages), len(tokens) / self.token_rate)
+        return "".join(tokens).strip()
+
+    def get_response_stream(self, messages, tools=None, tool_calls=None,
+                            call_type="answer", models=None): # pylint: disable=unused-argument
+        """
+        Fake of OpenAICli.get_response_stream
+        """
+        if models is not None:
+            models.append(self.model)
+        rng = self.completion.rng(json.dumps(messages))
+        tokens = self._answer(messages, rng)
+        start = time.perf_counter()
+        self.completion.call(json.dumps(messages))
+        for token in tokens:
+            time.sleep(1.0 / self.token_rate)
+            yield token
+        self.completion.recorder.record("completion_stream", time.perf_counter() - start)
+
+    async def aget_response(self, messages, tools=None, tool_calls=None,
+                            call_type="answer", models=None): # pylint: disable=unused-argument
+        """
+        Fake of OpenAICli.aget_response
+        """
+        if models is not None:
+            models.append(self.model)
+        rng = self.completion.rng(json.dumps(messages))
+        tokens = self._answer(messages, rng)
+        await self.completion.acall(json.dumps(messages), len(tokens) / self.token_rate)
+        return "".join(tokens).strip()
+
+    async def aget_response_stream(self, messages, tools=None, tool_calls=None, call_type="answer",
+                                   models=None): # pylint: disable=unused-argument
+        """
+        Fake of OpenAICli.aget_response_stream
+        """
+        import asyncio # pylint: disable=import-outside-toplevel
+        if models is not None:
+            models.append(self.model)
+        rng = self.completion.rng(json.dumps(messages))
+        tokens = self._answer(messages, rng)
+        await self.completion.acall(json.dumps(messages))
+        for token in tokens:
+            await asyncio.sleep(1.0 / self.token_rate)
+            yield token
+
+    @staticmethod
+    def _vector(text):
+        """
+        Build a deterministic fake embedding
+        """
+        digest = hashlib.sha256(text.encode("utf8")).digest()
+        return [byte / 255.0 for byte in digest[:16]]
+
+    def get_embedding(self, text, model="fake"): # pylint: disable=unused-argument
+        """
+        Fake of OpenAICli.get_embedding
+        """
+        self.embedding.call(text)
+        return self._vector(text)
+
+    def get_embeddings(self, texts, model="fake"): # pylint: disable=unused-argument
+        """
+        Fake of OpenAICli.get_embeddings, one simulated request for the whole batch
+        """
+        self.embedding.call("\n".join(texts))
+        return [self._vector(text) for text in texts]
+
+    async def aget_embedding(self, text, model="fake"): # pylint: disable=unused-argument
+        """
+        Fake of OpenAICli.aget_embedding
+        """
+        await self.embedding.acall(text)
+        return self._vector(text)
+
+
+class FakeIndexCli:
+    """
+    This class fakes PineconeCli: an embedding call followed by an index query
+    """
+    embedding_model = "fake"
+
+    def __init__(self, oai, recorder, seed, options):
+        self.oac = oai
+        self.query = FakeBackend("index_query", recorder, seed, options.query_ms,
+                                 options.sigma, options.error_rate)
+
+    def upsert_vectors(self, vectors, index_name="fake"): # pylint: disable=unused-argument
+        """
+        Fake of PineconeCli.upsert_vectors
+        """
+        self.query.call(len(vectors))
+
+    def find_matches(self, text, n=10, index_name="fake"): # pylint: disable=unused-argument
+        """
+        Fake of PineconeCli.find_matches
+        """
+        self.oac.get_embedding(text)
+        self.query.call(text)
+        return list(FAKE_FACTS)
+
+    async def afind_matches(self, text, n=10, index_name="fake"): # pylint: disable=unused-argument
+        """
+        Fake of PineconeCli.afind_matches
+        """
+        await self.oac.aget_embedding(text)
+        await self.query.acall(text)
+        return list(FAKE_FACTS)
+
+
+class FakeTools:
+    """
+    This class fakes the tool APIs of Tools, the search tool sleeps like a SerpAPI call
+    The fakes are registered on a real Tools instance, so the concurrent tool calls and
+    the timeouts of Tools are part of the benchmark
+    """
+
+    def __init__(self, recorder, seed, options):
+        self.search = FakeBackend("tool_search", recorder, seed, options.search_ms,
+                                  options.sigma, options.error_rate)
+
+    def query_serpapi(self, parameter):
+        """
+        Fake of Tools.query_serpapi
+        """
+        self.search.call(f"search:{parameter}")
+        return f"search result for {parameter}", ["https://example.com"]
+
+    async def aquery_serpapi(self, parameter):
+        """
+        Fake of Tools.aquery_serpapi
+        """
+        await self.search.acall(f"search:{parameter}")
+        return f"search result for {parameter}", ["https://example.com"]
+
+    @staticmethod
+    def get_default_context():
+        """
+        Fake of Tools.get_default_context, constant so prompts are reproducible
+        """
+        return "\nToday's date: 2000-01-01 00:00:00\n Current User: bench\n"
+
+    def install(self, tools):
+        """
+        Replace the search API and the default context of a Tools instance
+        """
+        tools.tool_apis["search"] = self.query_serpapi
+        tools.async_tool_apis["search"] = self.aquery_serpapi
+        tools.get_default_context = self.get_default_context
+        return tools
+
+
+class FakeAzureCli:
+    """
+    This class fakes AzureCli with an in-memory blob container
+    """
+
+    def __init__(self, recorder, seed, options):
+        self.blob = FakeBackend("blob", recorder, seed, options.blob_ms,
+                                options.sigma, options.error_rate)
+        self.blobs = {}
+        self.lock = threading.Lock()
+
+    def store_json_in_blob(self, json_object, blob_name):
+        """
+        Fake of AzureCli.store_json_in_blob
+        """
+        self.blob.call(blob_name)
+        with self.lock:
+            self.blobs[blob_name] = json_object
+
+    def get_json_from_blob(self, blob_name):
+        """
+        Fake of AzureCli.get_json_from_blob
+        """
+        self.blob.call(blob_name)
+        with self.lock:
+            return self.blobs[blob_name]
+
+    def get_blob_list(self):
+        """
+        Fake of AzureCli.get_blob_list
+        """
+        with self.lock:
+            return [type("Blob", (), {"name": name, "last_modified": None})
+                    for name in sorted(self.blobs)]
+
+    def delete_blob(self, blob_name):
+        """
+        Fake of AzureCli.delete_blob
+        """
+        self.blob.call(blob_name)
+        with self.lock:
+            self.blobs.pop(blob_name, None)
+
+
+def install_fakes(recorder, options):
+    """
+    Import the server and replace its backends with the fakes
+    """
+    # keep the real clients from touching the network or the disk on import
+    os.environ.setdefault("VECTOR_INDEX", "local")
+    os.environ.setdefault("EMBEDDING_CACHE_PATH", "")
+
+    from server import server # pylint: disable=import-outside-toplevel
+    from server.conversation import Conversation # pylint: disable=import-outside-toplevel
+    from server.sessions import SessionStore # pylint: disable=import-outside-toplevel
+    from server.tools import Tools # pylint: disable=import-outside-toplevel
+    from server.router import ModelRouter # pylint: disable=import-outside-toplevel
+
+    oai = FakeOpenAICli(recorder, options.seed, options)
+    oai.router = ModelRouter(oai.model)
+    index = FakeIndexCli(oai, recorder, options.seed, options)
+    Conversation.oai = oai
+    Conversation.pc = index
+    Conversation.tls = FakeTools(recorder, options.seed, options).install(Tools())
+    server.oai = oai
+    server.pc = index
+    server.azc = FakeAzureCli(recorder, options.seed, options)
+    server.sessions = SessionStore()
+    return server
+
+
+def start_server(server):
+    """
+    Start the Flask app on a free local port, returns the URL and the HTTP server
+    """
+    from werkzeug.serving import make_server # pylint: disable=import-outside-toplevel
+
+    http_server = make_server("127.0.0.1", 0, server.app, threaded=True)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    return f"http://127.0.0.1:{http_server.server_port}", http_server
+
+
+def generate_script(conversations, turns, seed):
+    """
+    Generate a reproducible list of conversations
+    """
+    rng = random.Random(seed)
+    return [[rng.choice(QUESTION_TEMPLATES).format(day=rng.choice(DAYS), topic=rng.choice(TOPICS))
+             for _ in range(turns)] for _ in range(conversations)]
+
+
+def run_conversation(url, conversation_id, questions, command):
+    """
+    Replay one conversation, returns a list of (latency, time to first token, ok)
+    """
+    results = []
+    session_id = f"bench-{conversation_id}"
+    with requests.Session() as http:
+        for question in questions:
+            data = {'text': question, 'command': command, 'session_id': session_id}
+            start = time.perf_counter()
+            first_token = None
+            try:
+                with http.post(url, json=data, stream=True, timeout=120) as response:
+                    ok = response.status_code == 200
+                    if command == "stream-response":
+                        for line in response.iter_lines(decode_unicode=True):
+                            if first_token is None and line.startswith("event: token"):
+                                first_token = time.perf_counter() - start
+                            if line.startswith("event: error"):
+                                ok = False
+                    else:
+                        ok = ok and not response.json().get('text', '').startswith("Sorry")
+            except requests.RequestException:
+                ok = False
+            results.append((time.perf_counter() - start, first_token, ok))
+    return results
+
+
+def run_benchmark(options):
+    """
+    Run the benchmark and build the report
+    """
+    recorder = StageRecorder()
+    server = install_fakes(recorder, options)
+    url, http_server = start_server(server)
+
+    if options.script:
+        with open(options.script, "r", encoding="utf8") as script_f:
+            script = json.load(script_f)
+    else:
+        script = generate_script(options.conversations, options.turns, options.seed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        futures = [executor.submit(run_conversation, url, i, questions, options.command)
+                   for i, questions in enumerate(script)]
+        results = [result for future in futures for result in future.result()]
+    duration = time.perf_counter() - start
+    http_server.shutdown()
+
+    latencies = [latency for latency, _, ok in results if ok]
+    first_tokens = [first for _, first, ok in results if ok and first is not None]
+    failed = sum(1 for _, _, ok in results if not ok)
+
+    return {
+        "config": {key: value for key, value in vars(options).items() if key != "output"},
+        "requests": len(results),
+        "failed": failed,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(results) / duration, 3) if duration > 0 else None,
+        "latency": summarize(latencies),
+        "time_to_first_token": summarize(first_tokens),
+        "stages": recorder.report(),
+    }
+
+
+def parse_args(argv=None):
+    """
+    Parse the command line
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot server with fake backends")
+    parser.add_argument('--script', type=str, help='JSON list of conversations to replay')
+    parser.add_argument('--conversations', type=int, default=32,
+                        help='Number of generated conversations')
+    parser.add_argument('--turns', type=int, default=5, help='Questions per generated conversation')
+    parser.add_argument('--concurrency', type=int, default=8, help='Conversations in flight')
+    parser.add_argument('--command', type=str, default='stream-response',
+                        choices=['stream-response', 'get-response'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--completion-ms', type=float, default=400,
+                        help='Median time to first token of a completion')
+    parser.add_argument('--token-rate', type=float, default=200, help='Tokens per second')
+    parser.add_argument('--answer-tokens', type=int, default=40)
+    parser.add_argument('--embedding-ms', type=float, default=60)
+    parser.add_argument('--query-ms', type=float, default=40)
+    parser.add_argument('--search-ms', type=float, default=800)
+    parser.add_argument('--blob-ms', type=float, default=30)
+    parser.add_argument('--sigma', type=float, default=0.3,
+                        help='Log-normal sigma of every latency distribution')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Probability that a backend call fails')
+    parser.add_argument('--tool-rate', type=float, default=0.1,
+                        help='Probability that an answer invokes the search tool')
+    parser.add_argument('-o', '--output', type=str, help='Write the report to this file')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # the server prints every request it handles, stdout is kept for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_benchmark(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as output_f:
+            json.dump(report, output_f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
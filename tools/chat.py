@@ -9,12 +9,19 @@ by a react front end.
 """
 import os
 import io
+import getpass
 import argparse
 import json
 import requests
 
 SERVER_URL = 'http://localhost:5000'
 APP_ID = os.environ.get('APP_ID')
+# The server keeps a separate chat history per session
+SESSION_ID = os.environ.get('CHAT_SESSION_ID', getpass.getuser())
+# Number of facts sent to the server per request when uploading a facts file
+FACT_BATCH_SIZE = 500
+# Keep-alive connection to the server
+HTTP_SESSION = requests.Session()
 
 def get_location():
     """
@@ -44,7 +51,7 @@ def get_weather():
     except Exception: # pylint: disable=broad-except
         return "Could not determine weather.", "OpenWeatherMap"
 
-def call_server(input_text, command):
+def call_server(input_text, command, timeout=10):
     """
     This is a command line client to the chatbot server
     It can be used to create a training file from the cloud and upload facts to the cloud
@@ -52,13 +59,16 @@ def call_server(input_text, command):
 
     This function calls the chat server. Possible commands are:
     get-response: get a response from the cloud
+    stream-response: get a response from the cloud as a stream (see stream_server)
     clear-history: clear the chat history
     write-fact: write a fact to the cloud
+    write-facts: write a list of facts to the cloud
+    create-training-file: create a training file from the facts newer than the given date
     """
     headers = {'Content-Type': 'application/json'}
-    data = {'text': input_text, 'command': command}
+    data = {'text': input_text, 'command': command, 'session_id': SESSION_ID}
 
-    response = requests.post(SERVER_URL, headers=headers, json=data, timeout=10)
+    response = HTTP_SESSION.post(SERVER_URL, headers=headers, json=data, timeout=timeout)
 
     if response.status_code == 200:
         result = json.loads(response.text)
@@ -68,16 +78,68 @@ def call_server(input_text, command):
 
     return result
 
+def stream_server(input_text, command):
+    """
+    Call the chat server and read its response as a stream of server-sent events
+    Yields (event, payload) tuples as they arrive. Possible events are:
+    token: a piece of the answer
+    reset: the tokens received so far are superseded (the server invoked a tool)
+    error: the server hit an error, payload contains the message
+    done: the response is complete, payload contains the full text and its type
+    """
+    headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream'}
+    data = {'text': input_text, 'command': command, 'session_id': SESSION_ID}
+
+    with HTTP_SESSION.post(SERVER_URL, headers=headers, json=data, stream=True,
+                       timeout=10) as response:
+        if response.status_code != 200:
+            print(f'Error: {response.text}')
+            return
+
+        event = 'message'
+        for line in response.iter_lines(decode_unicode=True):
+            if line is None or line == '':
+                continue
+            if line.startswith('event:'):
+                event = line[len('event:'):].strip()
+            elif line.startswith('data:'):
+                yield event, json.loads(line[len('data:'):].strip())
+                event = 'message'
+
 def upload_facts(filename):
     """
     Upload facts from the given filename to the cloud (Azure blob storage)
     The facts file should be a jsonl file with one fact per line
     """
     print(f'Uploading facts from file {filename} to cloud...')
+
+    def upload_batch(batch, line_numbers):
+        output = call_server(batch, 'write-facts', timeout=None)
+        if not output:
+            print(f'Batch starting at line {line_numbers[0]} failed')
+            return 0
+        for result in output['results']:
+            if result['status'] != 'ok':
+                print(f"Line {line_numbers[result['index']]}: {result['error']}")
+        return sum(1 for result in output['results'] if result['status'] == 'ok')
+
+    uploaded = 0
+    batch = []
+    line_numbers = []
     with io.open(filename, encoding='utf8') as f_lines:
-        for line in f_lines:
-            fact = json.loads(line)
-            call_server(fact, 'write-fact')
+        for line_number, line in enumerate(f_lines, start=1):
+            if not line.strip():
+                continue
+            batch.append(json.loads(line))
+            line_numbers.append(line_number)
+            if len(batch) >= FACT_BATCH_SIZE:
+                uploaded += upload_batch(batch, line_numbers)
+                batch = []
+                line_numbers = []
+    if batch:
+        uploaded += upload_batch(batch, line_numbers)
+
+    print(f'Uploaded {uploaded} facts.')
 
 def interactive_fact_upload():
     """
@@ -95,17 +157,33 @@ def create_training_file(newer_than):
     """
     Create an Open AI training file from the facts stored in the cloud (Azure blob storage)
     """
-    print(f'Creating training file with data newer than {args.newer_than}...')
-    call_server(newer_than, 'create-training-file')
+    print(f'Creating training file with data newer than {newer_than}...')
+    # the export can take a while for a large fact base
+    output = call_server(newer_than, 'create-training-file', timeout=None)
+    if output:
+        print(output['text'])
 
-def interactive_chat():
+def interactive_chat(stream=True):
     """
     Start an interactive chat session with the Open AI cloud
+    When streaming, the answer is rendered incrementally as the tokens arrive
     """
     while True:
         text = input("JSh> ")
-        output = call_server(text, 'get-response')
-        print(output['text'])
+        if not stream:
+            output = call_server(text, 'get-response')
+            print(output['text'])
+            continue
+
+        for event, payload in stream_server(text, 'stream-response'):
+            if event == 'token':
+                print(payload['text'], end='', flush=True)
+            elif event == 'reset':
+                # the partial answer was a tool invocation, the real answer follows
+                print('\n...', flush=True)
+            elif event == 'error':
+                print(payload['text'], end='', flush=True)
+        print()
 
 def clear_history():
     """
@@ -142,6 +220,8 @@ if __name__ == "__main__":
                   help='Clear the chat history')
     parser.add_argument('-f', '--facts-file', type=str, default='facts.json', \
                   help='Specify the facts file to use (remove custom delimiters)')
+    parser.add_argument('--no-stream', action='store_true', \
+                  help='Wait for the full answer instead of streaming it')
     parser.add_argument('-k', '--kill-all-facts', action='store_true', \
                   help='Kill all facts in the cloud (use with care!)')
 
@@ -157,7 +237,7 @@ if __name__ == "__main__":
             interactive_fact_upload()
         else :
             print('starting interactive chat')
-            interactive_chat()
+            interactive_chat(not args.no_stream)
     elif args.upload_facts:
         upload_facts(args.facts_file)
     elif args.kill_all_facts:
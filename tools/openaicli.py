@@ -1,31 +1,80 @@
+import math
 from openai import Embedding, ChatCompletion
+from server.embeddingcache import EmbeddingCache
+from server.scheduler import RequestScheduler, estimate_tokens
+
+
+def get_perplexity(choice):
+    """
+    Get the perplexity of a chat completion choice from the logprobs of its tokens
+    """
+    logprobs = choice.get('logprobs') or {}
+    tokens = logprobs.get('content') or []
+    if not tokens:
+        raise ValueError("The response has no token logprobs")
+    return math.exp(-sum(token['logprob'] for token in tokens) / len(tokens))
+
 
 class OpenAICli:
+    # the tuner re-embeds the same target responses many times, cache them across runs
+    embedding_cache = EmbeddingCache()
+    # paces and retries the calls so that a tuning run survives rate limits
+    scheduler = RequestScheduler()
+
     def __init__(self):
         return
             
-    def get_response(self, messages, hyperparameters, model="gpt-3.5-turbo-0301"):
+    def get_response(self, messages, hyperparameters, model="gpt-3.5-turbo", max_tokens=None,
+                     before_call=None):
         """
         This the main function to send the chat context to the GPT model and get a response.
         returns the response and the perplexity of the response
+        before_call is called before every attempt, retries included, and may raise to
+        stop the call
         """
+        args = {
+            "model": model,
+            "messages": messages,
+            "temperature": hyperparameters['temperature'],
+            "top_p": hyperparameters['top_p'],
+            "frequency_penalty": hyperparameters['frequency_penalty'],
+            "presence_penalty": hyperparameters['presence_penalty'],
+            "n": 1,
+            "logprobs": True,
+        }
+        if max_tokens is not None:
+            args["max_tokens"] = max_tokens
+
+        def request():
+            if before_call is not None:
+                before_call()
+            return ChatCompletion.create(**args)
 
-        response = ChatCompletion.create(
-            model=model,
-            messages=messages, 
-            temperature=hyperparameters['temperature'],
-            top_p=hyperparameters['top_p'], 
-            frequency_penalty=hyperparameters['frequency_penalty'],
-            presence_penalty=hyperparameters['presence_penalty'], 
-            n=1,
-            best_of=1)
+        response = self.scheduler.call(request, model, tokens=estimate_tokens(messages))
 
-        return response.choices[0].message.content.strip(), response.choices[0].attributes['perplexity']
+        choice = response.choices[0]
+        return choice.message.content.strip(), get_perplexity(choice)
     
     def get_embedding(self, text, model="text-similarity-davinci-001"):
         """
         This function returns the embedding of the text
         """
-        text = text.replace("\n", " ")
-        return Embedding.create(input = [text], model=model)['data'][0]['embedding']
-    
\ No newline at end of file
+        return self.embedding_cache.get_or_compute(
+            model, text, lambda text: self.create_embeddings([text], model)[0])
+
+    def get_embeddings(self, texts, model="text-similarity-davinci-001"):
+        """
+        This function returns the embeddings of a list of texts, in input order
+        Uncached texts are embedded in batches
+        """
+        return self.embedding_cache.get_or_compute_many(
+            model, texts, lambda batch: self.create_embeddings(batch, model))
+
+    def create_embeddings(self, texts, model):
+        """
+        This function embeds a batch of texts with one request, in input order
+        """
+        response = self.scheduler.call(
+            lambda: Embedding.create(input = texts, model=model), model, kind="embedding",
+            tokens=estimate_tokens(texts))
+        return [item['embedding'] for item in sorted(response['data'], key=lambda d: d['index'])]
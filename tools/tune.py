@@ -7,17 +7,54 @@ It uses two methods to evaluate the fitness of a candidate hyperparameter set:
 The fitness function is a weighted sum of the two methods. The tools invokes the algorithm with 
 different weights to find the optimal hyperparameters. The final judgement of the optimal
 hyperparameters is based on the human judgement of the generated text.
+
+The individuals of a population are evaluated concurrently. The perplexity and the similarity
+of each (hyperparameters, prompt) pair are memoized for the whole run, so duplicate
+individuals and the later weight pairs reuse them, and the embeddings of the target
+responses are computed once.
+
+The halving engine is a sample-efficient alternative to the genetic algorithm. It draws a
+sample of the grid and runs successive halving: the candidates are scored on a small subset
+of the prompts, the best third is kept and scored on a subset three times larger, until one
+candidate is left or the survivors score the same. The search stops when the budget of
+completion calls or tokens is spent, and its state is saved after every rung so that an
+interrupted search resumes where it stopped.
+
+Usage:
+    python -m tools.tune --workers 8 --rpm 3000
+    python -m tools.tune --engine halving --max-calls 2000 --max-tokens 1000000
 """
+import os
 import random
 import json
+import argparse
+import hashlib
+import threading
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.metrics.pairwise import cosine_similarity
+from server.scheduler import RequestScheduler, estimate_tokens
 from .openaicli import OpenAICli
 
 with open('training_data.json', 'r', encoding='utf-8') as file:
     training_data = json.load(file)
 
+# the training data holds a list of prompts and the list of their target responses
+target_responses = dict(zip(training_data['prompt'], training_data['response']))
+prompts = list(target_responses)
+
 oac = OpenAICli()
 
+# Number of fitness evaluations run concurrently, see also --rpm and --tpm
+FITNESS_WORKERS = int(os.environ.get("TUNE_WORKERS", "8"))
+
+# (hyperparameters, prompt) -> (perplexity, similarity), kept for the whole run
+fitness_memo = {}
+# prompt -> embedding of its target response, filled once by embed_targets
+target_vectors = {}
+# upper bound of the tokens of a generated response
+RESPONSE_MAX_TOKENS = int(os.environ.get("TUNE_MAX_TOKENS", "256"))
+
 # Define the hyperparameters
 temperature_range = [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
 top_p_range = [0.5, 0.7, 0.9, 1]
@@ -25,18 +62,115 @@ frequency_penalty_range = [0, 0.2, 0.4, 0.6, 0.8, 1.2, 1.4, 1.6, 1.8, 2]
 presence_penalty_range = [0, 0.2, 0.4, 0.6, 0.8, 1.2, 1.4, 1.6, 1.8, 2]
 
 
-def fitness(hyperparameters, messages, target_response, p_w, s_w):
+class BudgetExhausted(Exception):
     """
-    Define the fitness function
+    Raised when a completion call does not fit in the search budget
     """
-    generated_text, perplexity = oac.get_response(messages, hyperparameters)
+
+
+class CheckpointMismatch(Exception):
+    """
+    Raised when a checkpoint was written by a search with other parameters
+    """
+
+
+class SearchBudget:
+    """
+    This class is the budget of a search in completion calls and tokens, 0 is unlimited
+    Every attempt of a call, retries included, reserves one call and an upper bound of its
+    tokens (the prompt and RESPONSE_MAX_TOKENS) before it is sent. The reservation of a
+    call that answered is settled to the tokens it used, failed attempts stay counted
+    """
+
+    def __init__(self, max_calls=0, max_tokens=0):
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.calls = 0
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens):
+        """
+        Reserve a call and its tokens, raises BudgetExhausted when they do not fit
+        """
+        with self.lock:
+            if self.max_calls and self.calls + 1 > self.max_calls:
+                raise BudgetExhausted(f"The budget of {self.max_calls} calls is spent")
+            if self.max_tokens and self.tokens + tokens > self.max_tokens:
+                raise BudgetExhausted(f"The budget of {self.max_tokens} tokens is spent")
+            self.calls += 1
+            self.tokens += tokens
+
+    def settle(self, reserved, used):
+        """
+        Replace the reserved tokens of a call that answered by the tokens it used
+        """
+        with self.lock:
+            self.tokens += used - reserved
+
+    def affords(self, calls, tokens_per_call):
+        """
+        Check if the budget has room for a number of calls, their tokens are estimated from
+        the calls made so far, or with tokens_per_call before the first call
+        """
+        with self.lock:
+            average = self.tokens / self.calls if self.calls else tokens_per_call
+            if self.max_calls and self.calls + calls > self.max_calls:
+                return False
+            return not self.max_tokens or self.tokens + average * calls <= self.max_tokens
+
+
+# completion calls and tokens spent by the measures, see --max-calls and --max-tokens
+budget = SearchBudget()
+
+
+def embed_targets():
+    """
+    Embed the target responses once, in batches
+    """
+    vectors = oac.get_embeddings([target_responses[prompt] for prompt in prompts])
+    target_vectors.update(zip(prompts, vectors))
+
+
+def memo_key(hyperparameters, prompt):
+    """
+    Get the key of an evaluation in the memo table
+    """
+    return tuple(sorted(hyperparameters.items())), prompt
+
+
+def measure(hyperparameters, prompt):
+    """
+    Get the perplexity of the response to the prompt and its similarity to the target response
+    """
+    messages = [{"role": "user", "content": prompt}]
+    prompt_tokens = estimate_tokens(messages)
+    reserved = prompt_tokens + RESPONSE_MAX_TOKENS
+    generated_text, perplexity = oac.get_response(
+        messages, hyperparameters, max_tokens=RESPONSE_MAX_TOKENS,
+        before_call=lambda: budget.reserve(reserved))
+    budget.settle(reserved, prompt_tokens + estimate_tokens([generated_text]))
 
     generated_vector = oac.get_embedding(generated_text)
-    target_vector = oac.get_embedding(target_response)
-    similarity = cosine_similarity(
-        generated_vector.reshape(1, -1), target_vector.reshape(1, -1))
+    if prompt not in target_vectors:
+        target_vectors[prompt] = oac.get_embedding(target_responses[prompt])
+    similarity = cosine_similarity([generated_vector], [target_vectors[prompt]])[0][0]
+
+    return float(perplexity), float(similarity)
+
+
+def fitness(hyperparameters, prompt, p_w, s_w):
+    """
+    Define the fitness function
+    The measures are memoized, only the weights are applied on every call
+    """
+    key = memo_key(hyperparameters, prompt)
+    if key not in fitness_memo:
+        fitness_memo[key] = measure(hyperparameters, prompt)
+    perplexity, similarity = fitness_memo[key]
+
     score = p_w * \
-        (1.0 / float(perplexity)) + s_w * similarity[0][0]
+        (1.0 / perplexity) + s_w * similarity
 
     return score
 
@@ -63,17 +197,62 @@ def generate_population(population_size=100):
     return population
 
 
+def _measure_safely(hyperparameters, prompt):
+    """
+    Measure an individual, returns (measures, None) or (None, error) when the calls fail
+    so that it is retried later
+    """
+    try:
+        return measure(hyperparameters, prompt), None
+    except BudgetExhausted as err:
+        return None, err
+    except Exception as err: # pylint: disable=broad-except
+        print(f"Could not evaluate {hyperparameters}:", err)
+        return None, err
+
+
+def measure_pairs(pairs):
+    """
+    Measure the (hyperparameters, prompt) pairs that are not in the memo table
+    They are measured concurrently, each distinct pair once. When every measure fails the
+    failure is systematic (bad key, model or request) and the run is aborted. Once the
+    budget is spent the calls in flight finish and BudgetExhausted is raised
+    """
+    missing = {}
+    for individual, prompt in pairs:
+        key = memo_key(individual, prompt)
+        if key not in fitness_memo:
+            missing.setdefault(key, (individual, prompt))
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=FITNESS_WORKERS) as executor:
+        results = executor.map(lambda item: _measure_safely(*item), missing.values())
+        for key, (result, err) in zip(missing, results):
+            if err is None:
+                fitness_memo[key] = result
+            else:
+                errors.append(err)
+
+    exhausted = [err for err in errors if isinstance(err, BudgetExhausted)]
+    if exhausted:
+        raise exhausted[0]
+    if missing and len(errors) == len(missing):
+        raise RuntimeError(f"All {len(missing)} evaluations failed") from errors[-1]
+
+
 def evaluate_population(population, p_w, s_w):
     """
-    Evaluate the fitness of each individual in the population
+    Evaluate the fitness of each individual in the population on a random prompt
     """
+    chosen = [random.choice(prompts) for _ in population]
+    measure_pairs(zip(population, chosen))
+
     fitness_scores = []
-    for individual in population:
-        prompt = random.choice(training_data['prompt'])
-        target_response = training_data.loc[training_data['prompt']
-                                            == prompt, 'response'].values[0]
-        score = fitness(individual, prompt, target_response, p_w, s_w)
-        fitness_scores.append(score)
+    for individual, prompt in zip(population, chosen):
+        if memo_key(individual, prompt) in fitness_memo:
+            fitness_scores.append(fitness(individual, prompt, p_w, s_w))
+        else:
+            fitness_scores.append(float('-inf'))
 
     return fitness_scores
 
@@ -171,7 +350,6 @@ def run_genetic_algorithm(strategy, population_size, num_generations, p_w, s_w):
     alpha_parent = population[fitness_scores.index(max(fitness_scores))]
 
     # Evolution loop
-    num_generations = 10
     for generation in range(num_generations):
         print('Generation:', generation)
         new_population = evolve_population(strategy,
@@ -204,6 +382,207 @@ def run_with_strategy(strategy, population_size, generations):
               similarity_weight:{similarity_weight},\
               Best individual:{best_individual}')
 
+
+def generate_grid():
+    """
+    Generate every individual of the hyperparameter grid
+    """
+    return [{'temperature': temperature, 'top_p': top_p, 'frequency_penalty': \
+             frequency_penalty, 'presence_penalty': presence_penalty}
+            for temperature, top_p, frequency_penalty, presence_penalty in product(
+                temperature_range, top_p_range, frequency_penalty_range,
+                presence_penalty_range)]
+
+
+def get_search_params(num_candidates, eta, seed):
+    """
+    Get the parameters a checkpoint is only valid for, the training data is fingerprinted
+    since the measures depend on the prompts and the target responses
+    """
+    data = json.dumps(training_data, sort_keys=True, ensure_ascii=False)
+    return {"candidates": num_candidates, "eta": eta, "seed": seed,
+            "data": hashlib.sha256(data.encode("utf8")).hexdigest()}
+
+
+def load_checkpoint(path, params):
+    """
+    Load the state of an interrupted search, the memo table and the spent budget are restored
+    A checkpoint written with other parameters or training data is refused
+    """
+    if not path or not os.path.exists(path):
+        return {"runs": {}, "params": params}
+
+    with open(path, 'r', encoding='utf-8') as checkpoint_f:
+        checkpoint = json.load(checkpoint_f)
+    saved = checkpoint.get("params", {})
+    changed = sorted(key for key in params if saved.get(key) != params[key])
+    if changed:
+        raise CheckpointMismatch(
+            f"The checkpoint {path} was written with other {', '.join(changed)}, "
+            "delete it or pass another --checkpoint to start a new search")
+
+    for hyperparameters, prompt, perplexity, similarity in checkpoint.pop("memo", []):
+        fitness_memo[memo_key(hyperparameters, prompt)] = (perplexity, similarity)
+    spent = checkpoint.pop("usage", {})
+    budget.calls, budget.tokens = spent.get("calls", 0), spent.get("tokens", 0)
+    print(f"Resuming the search from {path} after {budget.calls} completion calls")
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """
+    Save the state of the search with the memo table and the spent budget
+    The file is replaced atomically so that an interruption never leaves it half written
+    """
+    if not path:
+        return
+
+    memo = [[dict(key[0]), key[1], perplexity, similarity]
+            for key, (perplexity, similarity) in fitness_memo.items()]
+    with budget.lock:
+        spent = {"calls": budget.calls, "tokens": budget.tokens}
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as checkpoint_f:
+        json.dump(dict(checkpoint, memo=memo, usage=spent), checkpoint_f)
+    os.replace(temp_path, path)
+
+
+def score_candidates(candidates, subset, p_w, s_w):
+    """
+    Score each candidate with its mean fitness over the prompts of the subset
+    Candidates with a prompt that could not be measured score -inf
+    """
+    scores = []
+    for candidate in candidates:
+        if all(memo_key(candidate, prompt) in fitness_memo for prompt in subset):
+            scores.append(sum(fitness(candidate, prompt, p_w, s_w)
+                              for prompt in subset) / len(subset))
+        else:
+            scores.append(float('-inf'))
+    return scores
+
+
+def run_successive_halving(p_w, s_w, checkpoint, checkpoint_path, num_candidates=81,
+                           eta=3, min_prompts=1, tolerance=0.001, seed=0):
+    """
+    Run successive halving over a sample of the grid
+    Every rung scores the candidates on the first prompts of a shuffled order, keeps the
+    best 1/eta of them and multiplies the number of prompts by eta. The measures of the
+    earlier rungs are reused, so a rung only pays for the new prompts of its survivors.
+    A rung that does not fit in the budget is not started, and the search stops if the
+    budget runs out during a rung
+    """
+    run_key = f"{p_w},{s_w}"
+    state = checkpoint["runs"].get(run_key)
+    if state is None:
+        rng = random.Random(seed)
+        grid = generate_grid()
+        order = list(prompts)
+        rng.shuffle(order)
+        state = {"rung": 0, "num_prompts": min(min_prompts, len(order)), "order": order,
+                 "candidates": rng.sample(grid, min(num_candidates, len(grid))), "best": None}
+        checkpoint["runs"][run_key] = state
+    if state.get("done"):
+        return state["best"]
+
+    while True:
+        candidates = state["candidates"]
+        subset = state["order"][:state["num_prompts"]]
+        pairs = [(candidate, prompt) for candidate in candidates for prompt in subset]
+        missing = {memo_key(candidate, prompt): prompt for candidate, prompt in pairs}
+        for key in fitness_memo.keys() & missing.keys():
+            del missing[key]
+        tokens_per_call = max((estimate_tokens([{"role": "user", "content": prompt}])
+                               for prompt in missing.values()), default=0) + RESPONSE_MAX_TOKENS
+        if not budget.affords(len(missing), tokens_per_call):
+            print(f"Budget exhausted before rung {state['rung']}, {budget.calls} completion \
+calls and {budget.tokens} tokens spent")
+            break
+
+        try:
+            measure_pairs(pairs)
+        except BudgetExhausted as err:
+            # the measures made so far are kept in the checkpoint
+            print(f"{err} during rung {state['rung']}")
+            save_checkpoint(checkpoint_path, checkpoint)
+            break
+        scores = score_candidates(candidates, subset, p_w, s_w)
+        ranked = sorted(zip(scores, range(len(candidates))), reverse=True)
+        state["best"] = candidates[ranked[0][1]]
+        print(f"Rung:{state['rung']}, prompts:{len(subset)}, candidates:{len(candidates)}, \
+score:{ranked[0][0]:.4f}, Best individual:{state['best']}")
+
+        keep = max(1, len(candidates) // eta)
+        # the survivors are indistinguishable, more prompts would not change the winner
+        converged = ranked[0][0] - ranked[keep - 1][0] < tolerance
+        state["candidates"] = [candidates[index] for _, index in ranked[:keep]]
+        state["num_prompts"] = min(len(state["order"]), state["num_prompts"] * eta)
+        state["rung"] += 1
+        state["done"] = keep == 1 or converged
+        save_checkpoint(checkpoint_path, checkpoint)
+        if state["done"]:
+            break
+
+    return state["best"]
+
+
+def run_with_halving(checkpoint_path, num_candidates, eta, seed):
+    """
+    Run successive halving with the same weights as the genetic algorithm
+    The runs draw the same sample of the grid, so the later weights reuse the measures
+    """
+    checkpoint = load_checkpoint(checkpoint_path, get_search_params(num_candidates, eta, seed))
+    weights = [(0, 1), (1, 0), (0.25, 0.75), (0.75, 0.25), (0.5, 0.5)]
+
+    for perplexity_weight, similarity_weight in weights:
+        best_individual = run_successive_halving(perplexity_weight, similarity_weight,
+            checkpoint, checkpoint_path, num_candidates, eta, seed=seed)
+        print(f'perplexity_weight:{perplexity_weight},\
+              similarity_weight:{similarity_weight},\
+              Best individual:{best_individual}')
+
+    print(f"{budget.calls} completion calls and {budget.tokens} tokens spent")
+
+
 if __name__ == '__main__':
-    run_with_strategy('crossover', 100, 10)
-    run_with_strategy('alpha', 100, 10)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=FITNESS_WORKERS,
+                        help='Number of fitness evaluations run concurrently')
+    parser.add_argument('--rpm', type=int, default=RequestScheduler.requests_per_minute,
+                        help='OpenAI requests per minute, 0 disables the limit')
+    parser.add_argument('--tpm', type=int, default=RequestScheduler.tokens_per_minute,
+                        help='OpenAI tokens per minute, 0 disables the limit')
+    parser.add_argument('-e', '--engine', choices=['genetic', 'halving'], default='genetic',
+                        help='Search engine')
+    parser.add_argument('-g', '--generations', type=int, default=10,
+                        help='Generations of the genetic algorithm')
+    parser.add_argument('--candidates', type=int, default=81,
+                        help='Candidates sampled from the grid by the halving engine')
+    parser.add_argument('--eta', type=int, default=3,
+                        help='Reduction factor of the halving engine')
+    parser.add_argument('--max-calls', type=int, default=0,
+                        help='Budget of completion calls, 0 is unlimited')
+    parser.add_argument('--max-tokens', type=int, default=0,
+                        help='Budget of completion tokens, 0 is unlimited')
+    parser.add_argument('--checkpoint', default='tune.checkpoint.json',
+                        help='State file of the halving engine, the search resumes from it')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the sample of the grid')
+    args = parser.parse_args()
+
+    FITNESS_WORKERS = args.workers
+    budget.max_calls, budget.max_tokens = args.max_calls, args.max_tokens
+    oac.scheduler = RequestScheduler(requests_per_minute=args.rpm, tokens_per_minute=args.tpm)
+
+    embed_targets()
+    if args.engine == 'halving':
+        try:
+            run_with_halving(args.checkpoint, args.candidates, args.eta, args.seed)
+        except CheckpointMismatch as err:
+            parser.error(str(err))
+    else:
+        try:
+            run_with_strategy('crossover', 100, args.generations)
+            run_with_strategy('alpha', 100, args.generations)
+        except BudgetExhausted as err:
+            print(err)